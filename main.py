@@ -1,19 +1,29 @@
+import hashlib
 import os
-import requests
+import sys
 import telebot
 import threading
-import queue
-import shutil
+import signal
 import logging
 
 from dotenv import load_dotenv
-from subprocess import run
-from src.localization import get_localized, get_language_code
-from src.message_handlers import add_handlers, get_base_markup
-from src.utils import get_dir_name, generate_transcription, get_full_completed_text
-from src.db.db import save_transcription
-
-q = queue.Queue()
+from urllib.parse import urlparse
+from telebot.async_telebot import AsyncTeleBot
+from src.message_handlers import add_handlers
+from src.processing import start_workers, stop_workers
+from src.transcription import start_callback_server
+from src.http_client import start_metrics_logger, log_metrics, close_sessions
+from src.aio import run_sync
+from src.backends import start_health_checks
+from src.limits import get_int_env
+from src.prompt_registry import start_prompt_registry
+from src.summarization import start_precomputing
+from src.db.db import start_pool_metrics_logger, log_pool_metrics
+from src.user_registry import flush_users
+
+MODE_ALL = "all"
+MODE_INGEST = "ingest"
+MODE_WORKER = "worker"
 
 logging.basicConfig(
     format="%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s]  %(message)s",
@@ -21,175 +31,150 @@ logging.basicConfig(
 )
 
 
-def worker() -> None:
-    logging.info("The queue worker has been started")
-    while True:
-        item = q.get()
-        bot: telebot.TeleBot = item.get("bot")
-        message: telebot.types.Message = item.get("message")
-        bot_message_id = item.get("bot_message_id")
+def create_bot(mode: str) -> telebot.TeleBot:
+    # Проверка наличия токенов
+    if not (tg_token := os.getenv("TG_API_KEY")):
+        raise ValueError("TG_API_KEY не найден в переменных окружения")
 
-        code = get_language_code(message)
+    if mode != MODE_WORKER and not (os.getenv("LLM_URL")):
+        raise ValueError("LLM_URL не найден в переменных окружения")
 
-        bot.edit_message_text(
-            chat_id=message.chat.id,
-            text=get_localized("start_processing", code),
-            message_id=bot_message_id,
+    if mode != MODE_INGEST and not os.getenv("WHISPERX_API_ADDRESS"):
+        raise ValueError(
+            "WHISPERX_API_ADDRESS не найден - диаризация может не работать"
         )
 
-        process_message(message, bot, bot_message_id)
+    # Обработчики обновлений выполняются в пуле из стольких потоков
+    bot = telebot.TeleBot(tg_token, num_threads=get_int_env("TG_HANDLER_THREADS", 4))
 
-        q.task_done()
+    api_addr = os.getenv("TG_API_ADDRESS")
+    if not api_addr:
+        raise ValueError("Локальный адрес для бота не установлен!")
 
+    if mode != MODE_INGEST and not os.getenv("TG_FILES_API_ADDRESS"):
+        raise ValueError("Локальный адрес для файлов бота не установлен!")
 
-def process_message(
-    message: telebot.types.Message, bot: telebot.TeleBot, bot_message_id: int
-) -> None:
-    code = get_language_code(message)
-    dir_name = get_dir_name(message.chat.id, bot_message_id)
-    file_name = ""
-    try:
-        file_api = os.getenv("TG_FILES_API_ADDRESS")
-        tg_api = os.getenv("TG_API_KEY")
-        file_url = f"{file_api}/file/bot{tg_api}"
+    telebot.apihelper.API_URL = api_addr + "/bot{0}/{1}"
+    telebot.asyncio_helper.API_URL = api_addr + "/bot{0}/{1}"
 
-        os.mkdir(dir_name)
+    return bot
 
-        file_server_path = ""
-        if message.audio or message.voice:
-            if message.audio:
-                file_name = f"{dir_name}/{message.audio.file_name}"
-                file_server_path = bot.get_file(message.audio.file_id).file_path
 
-            elif message.voice:
-                file_name = f"{dir_name}/voice.ogg"
-                file_server_path = bot.get_file(message.voice.file_id).file_path
+def run_ingest(bot: telebot.TeleBot) -> None:
+    """Принимает обновления от Telegram и ставит файлы в очередь.
 
-            file_full_server_path = f"{file_url}{file_server_path}"
+    Запросы к LLM (саммари, ответы на произвольные запросы) выполняются здесь же,
+    в очереди src/llm_queue.py, а не воркерами: их число ограничивает
+    LLM_CONCURRENCY по слотам сервера LLM, а не WORKER_REPLICAS.
+    """
+    add_handlers(bot)
+    start_precomputing()
 
-            response = requests.get(file_full_server_path)
+    if webhook_url := os.getenv("TG_WEBHOOK_URL"):
+        run_webhooks(bot, webhook_url)
+        return
 
-            with open(file_name, "wb") as file:
-                file.write(response.content)
+    # Пока установлен вебхук, getUpdates не работает
+    bot.remove_webhook()
 
-        else:
-            video_file_name = ""
-            video_file_server_path = ""
-
-            if message.video:
-                video_file_name = f"{dir_name}/{message.video.file_name}"
-                for i in range(3):
-                    try:
-                        video_file_server_path = bot.get_file(
-                            message.video.file_id
-                        ).file_path
-                        break
-                    except Exception as e:
-                        logging.error(e)
-                        if i < 2:
-                            continue
-                        raise e
-
-            elif message.document:
-                video_file_name = f"{dir_name}/{message.document.file_name}"
-                video_file_server_path = bot.get_file(
-                    message.document.file_id
-                ).file_path
-
-            else:
-                bot.edit_message_text(
-                    chat_id=message.chat.id,
-                    message_id=bot_message_id,
-                    text=get_localized("unknown_content_type", code),
-                )
-                return
-            response = requests.get(f"{file_url}{video_file_server_path}")
-
-            with open(video_file_name, "wb") as file:
-                file.write(response.content)
-
-            file_name = f"{dir_name}/audio.aac"
-
-            run(
-                f'ffmpeg -i "{video_file_name}" -acodec aac -b:a 192k "{file_name}"',
-                shell=True,
-                check=True,
-            )
-            os.remove(video_file_name)
-
-        process_audio(file_name, message, bot, bot_message_id)
-
-        logging.info("Done")
-    except Exception as e:
-        logging.error("Ошибка обработки аудио")
-        logging.error(e)
-        bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=bot_message_id,
-            text=get_localized("processing_error", code),
+    # docker останавливает контейнер через SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: bot.stop_polling())
+
+    logging.info("🎧 Бот запущен. Ожидание аудиофайлов...")
+    bot.infinity_polling()
+
+
+def run_webhooks(bot: telebot.TeleBot, webhook_url: str) -> None:
+    """Получает обновления через вебхук вместо long polling.
+
+    Сервер (uvicorn) слушает TG_WEBHOOK_LISTEN:TG_WEBHOOK_PORT за обратным прокси,
+    webhook_url - внешний адрес, который Bot API сервер будет вызывать.
+    Сервер принимает запросы по пути из webhook_url или TG_WEBHOOK_PATH,
+    если прокси его меняет.
+    """
+    # Секрет должен совпадать у всех реплик за одним адресом
+    secret_token = os.getenv("TG_WEBHOOK_SECRET") or hashlib.sha256(
+        bot.token.encode()
+    ).hexdigest()[:32]
+
+    parsed_url = urlparse(webhook_url)
+    url_path = (os.getenv("TG_WEBHOOK_PATH") or parsed_url.path).strip("/")
+    if not url_path:
+        raise ValueError(
+            "В TG_WEBHOOK_URL нет пути, например https://example.com/telegram"
         )
-    finally:
-        try:
-            shutil.rmtree(dir_name)
-        except:
-            logging.error(f'Error removing "{dir_name}"')
-
-
-def process_audio(
-    audio_file_name: str,
-    message: telebot.types.Message,
-    bot: telebot.TeleBot,
-    bot_message_id: int,
-):
-    code = get_language_code(message)
-    transcription = generate_transcription(audio_file_name)
-    save_transcription(
-        transcription, message.from_user.id, message.chat.id, bot_message_id
-    )
 
-    bot.edit_message_text(
-        chat_id=message.chat.id,
-        message_id=bot_message_id,
-        text=get_full_completed_text(code),
-        reply_markup=get_base_markup(code),
+    # Сервер слушает путь со слешем на конце, без него Bot API получал бы редирект
+    if not parsed_url.path.endswith("/"):
+        webhook_url = parsed_url._replace(path=f"{parsed_url.path}/").geturl()
+
+    logging.info("🎧 Бот запущен в режиме вебхука. Ожидание аудиофайлов...")
+    bot.run_webhooks(
+        listen=os.getenv("TG_WEBHOOK_LISTEN") or "0.0.0.0",
+        port=get_int_env("TG_WEBHOOK_PORT", 8443),
+        url_path=url_path,
+        webhook_url=webhook_url,
+        max_connections=get_int_env("TG_WEBHOOK_MAX_CONNECTIONS", 40),
+        secret_token=secret_token,
     )
 
 
-def main():
-    load_dotenv()
+def run_worker(bot: telebot.TeleBot) -> None:
+    """Обрабатывает задания из очереди, пока процесс не остановят."""
+    start_callback_server()
+    start_health_checks()
 
-    if not os.path.exists("files"):
-        os.mkdir("files")
+    workers = start_workers(AsyncTeleBot(bot.token))
 
-    # Проверка наличия токенов
-    if not (tg_token := os.getenv("TG_API_KEY")):
-        raise ValueError("TG_API_KEY не найден в переменных окружения")
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
 
-    if not (os.getenv("LLM_URL")):
-        raise ValueError("LLM_URL не найден в переменных окружения")
+    logging.info("⚙️ Воркеры запущены. Ожидание заданий...")
+    stop_event.wait()
+    stop_workers(workers)
 
-    if not os.getenv("WHISPERX_API_ADDRESS"):
-        raise ValueError(
-            "WHISPERX_API_ADDRESS не найден - диаризация может не работать"
-        )
 
-    bot = telebot.TeleBot(tg_token)
+def run_all(bot: telebot.TeleBot) -> None:
+    start_callback_server()
+    start_health_checks()
 
-    api_addr = os.getenv("TG_API_ADDRESS")
-    if not api_addr:
-        raise ValueError("Локальный адрес для бота не установлен!")
+    workers = start_workers(AsyncTeleBot(bot.token))
 
-    if not os.getenv("TG_FILES_API_ADDRESS"):
-        raise ValueError("Локальный адрес для файлов бота не установлен!")
+    try:
+        run_ingest(bot)
+    finally:
+        stop_workers(workers)
 
-    telebot.apihelper.API_URL = api_addr + "/bot{0}/{1}"
 
-    add_handlers(bot, q)
+def main():
+    load_dotenv()
 
-    threading.Thread(target=worker).start()
+    mode = sys.argv[1] if len(sys.argv) > 1 else MODE_ALL
+    if mode not in (MODE_ALL, MODE_INGEST, MODE_WORKER):
+        raise ValueError(f"Неизвестный режим запуска: {mode}")
 
-    logging.info("🎧 Бот запущен. Ожидание аудиофайлов...")
-    bot.infinity_polling()
+    if not os.path.exists("files"):
+        os.mkdir("files")
+
+    bot = create_bot(mode)
+    start_metrics_logger()
+    start_pool_metrics_logger()
+    start_prompt_registry()
+
+    try:
+        if mode == MODE_INGEST:
+            run_ingest(bot)
+        elif mode == MODE_WORKER:
+            run_worker(bot)
+        else:
+            run_all(bot)
+    finally:
+        flush_users()
+        run_sync(close_sessions())
+        log_metrics()
+        log_pool_metrics()
+        logging.info("Бот остановлен")
 
 
 if __name__ == "__main__":
@@ -35,7 +35,6 @@ def upgrade() -> None:
         .where(table.c.name == "short_summary")
         .values(text=short_summary_prompt)
     )
-    conn.commit()
     # ### end Alembic commands ###
 
 
@@ -0,0 +1,45 @@
+"""prompts notify
+
+Revision ID: c8d3f1a6b254
+Revises: a4c1e5b7d920
+Create Date: 2026-10-18 17:05:52.218437
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c8d3f1a6b254'
+down_revision: Union[str, Sequence[str], None] = 'a4c1e5b7d920'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Процессы бота держат промпты в памяти и сбрасывают кэш по этому уведомлению
+    op.execute(
+        """
+        CREATE FUNCTION notify_prompts_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('prompts_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER prompts_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prompts
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_prompts_changed()
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TRIGGER prompts_changed ON prompts")
+    op.execute("DROP FUNCTION notify_prompts_changed()")
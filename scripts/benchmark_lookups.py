@@ -0,0 +1,102 @@
+"""Сравнивает скорость поиска транскрипции и саммари без индексов и с ними.
+
+Данные генерируются во временных таблицах, рабочие таблицы не затрагиваются:
+
+    python scripts/benchmark_lookups.py --rows 500000 --queries 200
+"""
+
+import argparse
+import random
+import time
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+SEED = """
+CREATE TEMP TABLE bench_transcriptions AS
+SELECT
+    id,
+    (id % 5000) AS chat_id,
+    id AS message_id,
+    repeat('текст транскрипции ', 50) AS text
+FROM generate_series(1, :rows) AS id;
+
+CREATE TEMP TABLE bench_summaries AS
+SELECT
+    row_number() OVER () AS id,
+    t.id AS transcription_id,
+    p.prompt_id,
+    repeat('текст саммари ', 20) AS text
+FROM bench_transcriptions t
+CROSS JOIN generate_series(1, 3) AS p(prompt_id);
+"""
+
+INDEXES = """
+CREATE UNIQUE INDEX ON bench_transcriptions (chat_id, message_id);
+CREATE UNIQUE INDEX ON bench_summaries (transcription_id, prompt_id);
+"""
+
+GET_TRANSCRIPTION = text(
+    "SELECT * FROM bench_transcriptions "
+    "WHERE chat_id = :chat_id AND message_id = :message_id"
+)
+GET_SUMMARY = text(
+    "SELECT * FROM bench_summaries "
+    "WHERE transcription_id = :transcription_id AND prompt_id = :prompt_id"
+)
+
+
+def run_queries(conn, rows: int, queries: int) -> dict[str, float]:
+    ids = [random.randint(1, rows) for _ in range(queries)]
+    results = {}
+
+    started = time.perf_counter()
+    for i in ids:
+        conn.execute(GET_TRANSCRIPTION, dict(chat_id=i % 5000, message_id=i)).first()
+    results["get_transcription"] = (time.perf_counter() - started) / queries
+
+    started = time.perf_counter()
+    for i in ids:
+        params = dict(transcription_id=i, prompt_id=i % 3 + 1)
+        conn.execute(GET_SUMMARY, params).first()
+    results["get_summary"] = (time.perf_counter() - started) / queries
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    load_dotenv()
+    engine = create_engine(os.getenv("DB_URL"))
+
+    with engine.connect() as conn:
+        print(f"Seeding {args.rows} transcriptions and {args.rows * 3} summaries...")
+        for statement in SEED.split(";"):
+            if statement.strip():
+                conn.execute(text(statement), dict(rows=args.rows))
+        conn.execute(text("ANALYZE bench_transcriptions; ANALYZE bench_summaries"))
+
+        before = run_queries(conn, args.rows, args.queries)
+
+        for statement in INDEXES.split(";"):
+            if statement.strip():
+                conn.execute(text(statement))
+        conn.execute(text("ANALYZE bench_transcriptions; ANALYZE bench_summaries"))
+
+        after = run_queries(conn, args.rows, args.queries)
+
+    for name in before:
+        print(
+            f"{name}: {before[name] * 1000:.2f}ms without index, "
+            f"{after[name] * 1000:.2f}ms with index, "
+            f"{before[name] / after[name]:.0f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import concurrent.futures
+import threading
+import asyncio
+
+from typing import Any, Awaitable, Callable, Optional
+
+# Общий для процесса цикл событий: в нём работают конвейер обработки,
+# HTTP-клиенты и все остальные асинхронные задачи
+loop: Optional[asyncio.AbstractEventLoop] = None
+loop_lock = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global loop
+
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="aio", daemon=True).start()
+
+        return loop
+
+
+def submit(coro: Awaitable) -> concurrent.futures.Future:
+    """Запускает корутину в общем цикле, не дожидаясь результата."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro: Awaitable, timeout: Optional[float] = None) -> Any:
+    """Выполняет корутину в общем цикле и возвращает результат в вызывающий поток."""
+    return submit(coro).result(timeout)
+
+
+def call_soon(callback: Callable, *args) -> None:
+    get_loop().call_soon_threadsafe(callback, *args)
+
+
+async def gather(*coros: Awaitable) -> list:
+    """Как asyncio.gather, но при первой ошибке отменяет остальные задачи.
+
+    Возвращает управление, только когда отменённые задачи завершились.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,126 @@
+import threading
+import aiohttp
+import asyncio
+import logging
+import time
+import os
+
+from contextlib import contextmanager
+from typing import Optional
+from src.limits import get_int_env
+from src import http_client, aio
+from src.http_client import WHISPERX, CONNECT_TIMEOUT
+
+LEAST_LOADED = "least_loaded"
+ROUND_ROBIN = "round_robin"
+
+BALANCING = os.getenv("WHISPERX_BALANCING") or LEAST_LOADED
+HEALTH_CHECK_INTERVAL = get_int_env("WHISPERX_HEALTH_CHECK_INTERVAL", 30)
+HEALTH_CHECK_PATH = os.getenv("WHISPERX_HEALTH_CHECK_PATH") or "/docs"
+
+# Сколько секунд не отправлять задания на сервер после ошибки
+FAILURE_COOLDOWN = get_int_env("WHISPERX_FAILURE_COOLDOWN", 60)
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        self.active_jobs = 0
+        self.failed_at: Optional[float] = None
+
+    def is_available(self) -> bool:
+        return (
+            self.failed_at is None
+            or time.monotonic() - self.failed_at >= FAILURE_COOLDOWN
+        )
+
+    def __repr__(self):
+        return f"Backend({self.url}, active_jobs={self.active_jobs})"
+
+
+def parse_backends(value: str) -> list[Backend]:
+    return [Backend(url.strip().rstrip("/")) for url in value.split(",") if url.strip()]
+
+
+backends = parse_backends(os.getenv("WHISPERX_API_ADDRESS") or "")
+backends_lock = threading.Lock()
+next_backend_index = 0
+
+
+def pick_backend(exclude: list[Backend] = []) -> Optional[Backend]:
+    global next_backend_index
+
+    with backends_lock:
+        candidates = [
+            backend
+            for backend in backends
+            if backend not in exclude and backend.is_available()
+        ]
+        if not candidates:
+            # Все серверы недавно падали - лучше попробовать снова, чем отказать сразу
+            candidates = [backend for backend in backends if backend not in exclude]
+
+        if not candidates:
+            return None
+
+        if BALANCING == ROUND_ROBIN:
+            next_backend_index += 1
+            return candidates[next_backend_index % len(candidates)]
+
+        return min(candidates, key=lambda backend: backend.active_jobs)
+
+
+@contextmanager
+def use_backend(backend: Backend):
+    with backends_lock:
+        backend.active_jobs += 1
+
+    try:
+        yield backend
+    finally:
+        with backends_lock:
+            backend.active_jobs -= 1
+
+
+def mark_failed(backend: Backend) -> None:
+    if backend.failed_at is None:
+        logging.warning(f"WhisperX backend {backend.url} is unavailable")
+
+    backend.failed_at = time.monotonic()
+
+
+def mark_healthy(backend: Backend) -> None:
+    if backend.failed_at is not None:
+        logging.info(f"WhisperX backend {backend.url} is available again")
+
+    backend.failed_at = None
+
+
+async def check_health(backend: Backend) -> None:
+    try:
+        async with http_client.request(
+            WHISPERX,
+            "GET",
+            f"{backend.url}{HEALTH_CHECK_PATH}",
+            endpoint="health",
+            retries=0,
+            timeout=aiohttp.ClientTimeout(total=10, sock_connect=CONNECT_TIMEOUT),
+        ) as response:
+            # Любой ответ, кроме ошибки сервера, значит, что он жив
+            if response.status < 500:
+                mark_healthy(backend)
+            else:
+                mark_failed(backend)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        mark_failed(backend)
+
+
+async def check_health_periodically() -> None:
+    while True:
+        await asyncio.gather(*(check_health(backend) for backend in backends))
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+def start_health_checks() -> None:
+    if HEALTH_CHECK_INTERVAL:
+        aio.submit(check_health_periodically())
@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import time
+import re
+import os
+
+from datetime import timedelta
+from difflib import SequenceMatcher
+from typing import Optional
+from src.limits import get_int_env
+from src.db.db import (
+    get_custom_summary,
+    get_custom_summary_text,
+    get_custom_summaries,
+    touch_custom_summary,
+    save_custom_summary,
+    evict_custom_summaries,
+)
+
+# Запоминать ответы на произвольные запросы к транскрипциям
+CUSTOM_SUMMARY_CACHE = bool(get_int_env("CUSTOM_SUMMARY_CACHE", 1))
+# Сколько дней хранить ответ, которым никто не пользуется
+CUSTOM_SUMMARY_TTL_DAYS = get_int_env("CUSTOM_SUMMARY_TTL_DAYS", 30)
+# Сколько ответов хранить всего, лишние удаляются начиная с давно использованных
+CUSTOM_SUMMARY_CACHE_SIZE = get_int_env("CUSTOM_SUMMARY_CACHE_SIZE", 10000)
+# Минимальное сходство запросов, чтобы отдать ответ на похожий; 1 - только точное.
+# Почти одинаковые запросы могут спрашивать о разном ("кто согласился" и
+# "кто не согласился"), поэтому по умолчанию ответ отдаётся только на такой же
+CUSTOM_SUMMARY_SIMILARITY = float(os.getenv("CUSTOM_SUMMARY_SIMILARITY") or 1)
+
+# Сколько последних ответов к одной транскрипции сравнивать с запросом
+CANDIDATES_LIMIT = 100
+# Как часто удалять лишние ответы, в секундах
+EVICTION_INTERVAL = 60
+
+last_eviction = 0.0
+
+
+def normalize_prompt(prompt: str) -> str:
+    prompt = prompt.lower().replace("ё", "е")
+    prompt = re.sub(r"\s+", " ", prompt)
+    return prompt.strip(" .,!?…")
+
+
+def get_prompt_hash(normalized_prompt: str) -> str:
+    return hashlib.sha256(normalized_prompt.encode("utf-8")).hexdigest()
+
+
+def find_custom_summary(transcription_id: int, prompt: str) -> Optional[str]:
+    """Ищет ответ на такой же или, если разрешено, похожий запрос к транскрипции."""
+    if not CUSTOM_SUMMARY_CACHE:
+        return None
+
+    normalized = normalize_prompt(prompt)
+    max_age = timedelta(days=CUSTOM_SUMMARY_TTL_DAYS)
+
+    found = get_custom_summary(transcription_id, get_prompt_hash(normalized), max_age)
+    if found is not None:
+        touch_custom_summary(found.id)
+        return found.text
+
+    if CUSTOM_SUMMARY_SIMILARITY >= 1:
+        return None
+
+    # Сравниваются только запросы, текст подходящего ответа загружается отдельно
+    candidates = get_custom_summaries(transcription_id, max_age, CANDIDATES_LIMIT)
+
+    # Запросы, отличающиеся числами, почти одинаковы, но спрашивают о разном
+    numbers = re.findall(r"\d+", normalized)
+    best_ratio = CUSTOM_SUMMARY_SIMILARITY
+    for item in candidates:
+        if re.findall(r"\d+", item.prompt) != numbers:
+            continue
+
+        matcher = SequenceMatcher(None, normalized, item.prompt)
+        if matcher.quick_ratio() < best_ratio:
+            continue
+
+        ratio = matcher.ratio()
+        if ratio >= best_ratio:
+            found, best_ratio = item, ratio
+
+    if found is None:
+        return None
+
+    touch_custom_summary(found.id)
+    return get_custom_summary_text(found.id)
+
+
+def remember_custom_summary(transcription_id: int, prompt: str, text: str) -> None:
+    global last_eviction
+
+    if not CUSTOM_SUMMARY_CACHE:
+        return
+
+    normalized = normalize_prompt(prompt)
+    save_custom_summary(transcription_id, normalized, get_prompt_hash(normalized), text)
+
+    if time.monotonic() - last_eviction >= EVICTION_INTERVAL:
+        last_eviction = time.monotonic()
+        evicted = evict_custom_summaries(
+            timedelta(days=CUSTOM_SUMMARY_TTL_DAYS), CUSTOM_SUMMARY_CACHE_SIZE
+        )
+        if evicted:
+            logging.info(f"Evicted {evicted} cached custom summaries")
@@ -1,39 +1,190 @@
-from sqlalchemy import create_engine, select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import (
+    create_engine,
+    event,
+    select,
+    update,
+    delete,
+    literal,
+    func,
+    or_,
+    and_,
+)
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import sessionmaker, defer, Session as OrmSession
 from sqlalchemy.dialects.postgresql import insert
 from telebot import types
-from src.db.models import User, Transcription, Prompt, Summary
+from src.db.models import User, Transcription, Prompt, Summary, CustomSummary, Job
+from src.limits import get_int_env
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dotenv import load_dotenv
-from typing import Optional
-from datetime import datetime
+from typing import Iterator, Optional
+from datetime import timedelta
+import threading
+import logging
+import time
 import os
 
 load_dotenv()
-engine = create_engine(os.getenv("DB_URL"))
 
-Session = sessionmaker(engine)
+# Соединений в пуле на процесс; всего к Postgres откроется не больше
+# (DB_POOL_SIZE + DB_MAX_OVERFLOW) * число процессов
+engine = create_engine(
+    os.getenv("DB_URL"),
+    pool_size=get_int_env("DB_POOL_SIZE", 5),
+    max_overflow=get_int_env("DB_MAX_OVERFLOW", 10),
+    pool_timeout=get_int_env("DB_POOL_TIMEOUT", 30),
+    # Соединения, которые Postgres или прокси закрыл, пока они лежали в пуле
+    pool_pre_ping=bool(get_int_env("DB_POOL_PRE_PING", 1)),
+    pool_recycle=get_int_env("DB_POOL_RECYCLE", 1800),
+)
 
+DB_METRICS_INTERVAL = get_int_env("DB_METRICS_INTERVAL", 300)
 
-def register_user(message: types.Message) -> None:
+pool_metrics = {"connects": 0, "checkouts": 0, "checked_out": 0, "max_checked_out": 0}
+pool_metrics_lock = threading.Lock()
+
+
+@event.listens_for(engine, "connect")
+def on_connect(dbapi_connection, connection_record):
+    with pool_metrics_lock:
+        pool_metrics["connects"] += 1
+
+
+@event.listens_for(engine, "checkout")
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with pool_metrics_lock:
+        pool_metrics["checkouts"] += 1
+        pool_metrics["checked_out"] += 1
+        pool_metrics["max_checked_out"] = max(
+            pool_metrics["max_checked_out"], pool_metrics["checked_out"]
+        )
+
+
+@event.listens_for(engine, "checkin")
+def on_checkin(dbapi_connection, connection_record):
+    with pool_metrics_lock:
+        pool_metrics["checked_out"] -= 1
+
+
+# Отсоединённое соединение (например, для LISTEN в prompt_registry) уходит
+# из пула и в него уже не вернётся, поэтому checkin для него не будет
+@event.listens_for(engine, "detach")
+def on_detach(dbapi_connection, connection_record):
+    with pool_metrics_lock:
+        pool_metrics["checked_out"] -= 1
+
+
+def log_pool_metrics() -> None:
+    with pool_metrics_lock:
+        metrics = dict(pool_metrics)
+
+    logging.info(
+        f"DB pool: {metrics['checked_out']} connections in use, "
+        f"max {metrics['max_checked_out']}, "
+        f"{metrics['checkouts']} checkouts, {metrics['connects']} connects, "
+        f"{engine.pool.status()}"
+    )
+
+
+def log_pool_metrics_periodically() -> None:
+    while True:
+        time.sleep(DB_METRICS_INTERVAL)
+        log_pool_metrics()
+
+
+def start_pool_metrics_logger() -> None:
+    if DB_METRICS_INTERVAL:
+        threading.Thread(
+            target=log_pool_metrics_periodically, name="db-metrics", daemon=True
+        ).start()
+
+
+class ScopeSession(OrmSession):
+    scope: Optional["Scope"] = None
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            if self.scope is not None:
+                self.scope.lock.release()
+                self.scope = None
+
+
+class Scope:
+    def __init__(self):
+        self.connection: Optional[Connection] = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+current_scope: ContextVar[Optional[Scope]] = ContextVar("current_scope", default=None)
+session_factory = sessionmaker(engine, class_=ScopeSession)
+
+
+@contextmanager
+def session_scope() -> Iterator[None]:
+    """Единица работы: все запросы внутри блока идут через одно соединение.
+
+    Соединение берётся из пула при первом запросе и возвращается при выходе.
+    Транзакции по-прежнему свои у каждой функции. Если соединение уже занято
+    другим потоком, например задачей, созданной внутри блока, или блок уже
+    закончился, запрос выполняется через отдельное соединение из пула.
+    """
+    if current_scope.get() is not None:
+        yield
+        return
+
+    scope = Scope()
+    token = current_scope.set(scope)
+    try:
+        yield
+    finally:
+        current_scope.reset(token)
+        with scope.lock:
+            scope.closed = True
+            if scope.connection is not None:
+                scope.connection.close()
+
+
+def Session(**kwargs) -> ScopeSession:
+    scope = current_scope.get()
+    if scope is None or not scope.lock.acquire(blocking=False):
+        return session_factory(**kwargs)
+
+    try:
+        if scope.closed:
+            scope.lock.release()
+            return session_factory(**kwargs)
+
+        if scope.connection is None:
+            scope.connection = engine.connect()
+    except:
+        scope.lock.release()
+        raise
+
+    session = session_factory(bind=scope.connection, **kwargs)
+    session.scope = scope
+    return session
+
+
+def upsert_users(users: list[dict]) -> None:
+    """Создаёт или обновляет пользователей одним запросом.
+
+    Каждый элемент - словарь с id, user_name, first_name и last_name.
+    """
     with Session() as session:
         try:
-            stmt = (
-                insert(User)
-                .values(
-                    id=message.from_user.id,
-                    user_name=message.from_user.username,
-                    first_name=message.from_user.first_name,
-                    last_name=message.from_user.last_name,
-                )
-                .on_conflict_do_update(
-                    set_=dict(
-                        user_name=message.from_user.username,
-                        first_name=message.from_user.first_name,
-                        last_name=message.from_user.last_name,
-                        updated_at=datetime.now(),
-                    ),
-                    index_elements=["id"],
-                )
+            stmt = insert(User).values(users)
+            stmt = stmt.on_conflict_do_update(
+                set_=dict(
+                    user_name=stmt.excluded.user_name,
+                    first_name=stmt.excluded.first_name,
+                    last_name=stmt.excluded.last_name,
+                    updated_at=func.now(),
+                ),
+                index_elements=["id"],
             )
             session.execute(stmt)
         except:
@@ -67,25 +218,91 @@ def create_user(user_id: int, user_name: str):
             session.commit()
 
 
-def save_transcription(text: str, user_id: int, chat_id: int, message_id: int) -> None:
+def save_transcription(
+    text: str,
+    user_id: int,
+    chat_id: int,
+    message_id: int,
+    file_unique_id: Optional[str] = None,
+    audio_hash: Optional[str] = None,
+    precompute: bool = False,
+) -> int:
     with Session() as session:
         try:
-            stmt = insert(Transcription).values(
-                user_id=user_id, chat_id=chat_id, message_id=message_id, text=text
+            stmt = (
+                insert(Transcription)
+                .values(
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=text,
+                    file_unique_id=file_unique_id,
+                    audio_hash=audio_hash,
+                    precompute_pending=precompute,
+                )
+                .on_conflict_do_update(
+                    # Повторная обработка того же сообщения заменяет результат
+                    set_=dict(
+                        user_id=user_id,
+                        text=text,
+                        file_unique_id=file_unique_id,
+                        audio_hash=audio_hash,
+                        precompute_pending=precompute,
+                        updated_at=func.now(),
+                    ),
+                    index_elements=["chat_id", "message_id"],
+                )
+                .returning(Transcription.id)
+            )
+            transcription_id = session.execute(stmt).scalar_one()
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return transcription_id
+
+
+def claim_precompute() -> Optional[Transcription]:
+    """Забирает транскрипцию, для которой нужно заранее приготовить саммари.
+
+    Текст транскрипции не загружается.
+    """
+    with Session(expire_on_commit=False) as session:
+        try:
+            stmt = (
+                select(Transcription)
+                .options(defer(Transcription.text))
+                .where(Transcription.precompute_pending)
+                .order_by(Transcription.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
             )
-            session.execute(stmt)
+            transcription = session.execute(stmt).scalar_one_or_none()
+            if transcription is None:
+                return None
+
+            transcription.precompute_pending = False
+            session.flush()
         except:
             session.rollback()
             raise
         else:
             session.commit()
 
+    return transcription
+
 
-def get_transcription(message_id: int, chat_id: int) -> Optional[Transcription]:
+def get_transcription(
+    message_id: int, chat_id: int, with_text: bool = True
+) -> Optional[Transcription]:
     with Session() as session:
         stmt = select(Transcription).where(
             Transcription.chat_id == chat_id, Transcription.message_id == message_id
         )
+        if not with_text:
+            stmt = stmt.options(defer(Transcription.text))
         row = session.execute(stmt).first()
         if row is not None:
             return row[0]
@@ -93,9 +310,54 @@ def get_transcription(message_id: int, chat_id: int) -> Optional[Transcription]:
     return None
 
 
-def get_prompt_by_name(name: str) -> Optional[Prompt]:
+def get_transcription_text(transcription_id: int) -> Optional[str]:
     with Session() as session:
-        stmt = select(Prompt).where(Prompt.name == name)
+        stmt = select(Transcription.text).where(Transcription.id == transcription_id)
+        return session.execute(stmt).scalar_one_or_none()
+
+
+def get_transcription_with_summary(
+    message_id: int, chat_id: int, prompt_id: int
+) -> Optional[tuple[Transcription, Optional[Summary]]]:
+    """Находит транскрипцию сообщения и её саммари по промпту одним запросом.
+
+    Текст транскрипции не загружается, при необходимости его можно получить
+    через get_transcription_text.
+    """
+    with Session() as session:
+        stmt = (
+            select(Transcription, Summary)
+            .outerjoin(
+                Summary,
+                and_(
+                    Summary.transcription_id == Transcription.id,
+                    Summary.prompt_id == prompt_id,
+                ),
+            )
+            .where(
+                Transcription.chat_id == chat_id, Transcription.message_id == message_id
+            )
+            .options(defer(Transcription.text))
+        )
+        row = session.execute(stmt).first()
+        if row is not None:
+            return row[0], row[1]
+
+    return None
+
+
+def find_transcription(
+    file_unique_id: Optional[str] = None, audio_hash: Optional[str] = None
+) -> Optional[Transcription]:
+    if file_unique_id is None and audio_hash is None:
+        return None
+
+    with Session() as session:
+        stmt = select(Transcription).order_by(Transcription.id).limit(1)
+        if file_unique_id is not None:
+            stmt = stmt.where(Transcription.file_unique_id == file_unique_id)
+        else:
+            stmt = stmt.where(Transcription.audio_hash == audio_hash)
 
         row = session.execute(stmt).first()
         if row is not None:
@@ -104,6 +366,62 @@ def get_prompt_by_name(name: str) -> Optional[Prompt]:
     return None
 
 
+def copy_transcription(
+    source: Transcription, user_id: int, chat_id: int, message_id: int
+) -> None:
+    """Привязывает готовую транскрипцию и все её саммари к новому сообщению."""
+    with Session() as session:
+        try:
+            stmt = (
+                insert(Transcription)
+                .values(
+                    user_id=user_id,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=source.text,
+                    file_unique_id=source.file_unique_id,
+                    audio_hash=source.audio_hash,
+                )
+                .on_conflict_do_update(
+                    set_=dict(
+                        user_id=user_id,
+                        text=source.text,
+                        file_unique_id=source.file_unique_id,
+                        audio_hash=source.audio_hash,
+                        updated_at=func.now(),
+                    ),
+                    index_elements=["chat_id", "message_id"],
+                )
+                .returning(Transcription.id)
+            )
+            transcription_id = session.execute(stmt).scalar_one()
+
+            stmt = (
+                insert(Summary)
+                .from_select(
+                    ["prompt_id", "transcription_id", "text"],
+                    select(
+                        Summary.prompt_id, literal(transcription_id), Summary.text
+                    ).where(Summary.transcription_id == source.id),
+                )
+                .on_conflict_do_nothing(
+                    index_elements=["transcription_id", "prompt_id"]
+                )
+            )
+            session.execute(stmt)
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+
+def get_active_prompts() -> list[Prompt]:
+    with Session() as session:
+        stmt = select(Prompt).where(Prompt.deleted_at.is_(None)).order_by(Prompt.id)
+        return list(session.execute(stmt).scalars())
+
+
 def get_summary(transcription_id: int, prompt_id: int) -> Optional[Summary]:
     with Session() as session:
         stmt = select(Summary).where(
@@ -117,11 +435,83 @@ def get_summary(transcription_id: int, prompt_id: int) -> Optional[Summary]:
     return None
 
 
-def save_summary(text: str, transcription_id: int, prompt_id: int) -> None:
+def save_summary(text: str, transcription_id: int, prompt_id: int) -> str:
+    """Сохраняет саммари и возвращает текст, который оказался в базе.
+
+    Уже сохранённое саммари не заменяется: его мог видеть пользователь.
+    """
     with Session() as session:
         try:
-            stmt = insert(Summary).values(
-                transcription_id=transcription_id, prompt_id=prompt_id, text=text
+            stmt = (
+                insert(Summary)
+                .values(
+                    transcription_id=transcription_id, prompt_id=prompt_id, text=text
+                )
+                .on_conflict_do_nothing(
+                    index_elements=["transcription_id", "prompt_id"],
+                )
+                .returning(Summary.text)
+            )
+            saved_text = session.execute(stmt).scalar_one_or_none()
+            if saved_text is None:
+                saved_text = session.execute(
+                    select(Summary.text).where(
+                        Summary.transcription_id == transcription_id,
+                        Summary.prompt_id == prompt_id,
+                    )
+                ).scalar_one()
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return saved_text
+
+
+def get_custom_summary(
+    transcription_id: int, prompt_hash: str, max_age: timedelta
+) -> Optional[CustomSummary]:
+    with Session() as session:
+        stmt = select(CustomSummary).where(
+            CustomSummary.transcription_id == transcription_id,
+            CustomSummary.prompt_hash == prompt_hash,
+            CustomSummary.used_at > func.now() - max_age,
+        )
+        return session.execute(stmt).scalar_one_or_none()
+
+
+def get_custom_summary_text(custom_summary_id: int) -> Optional[str]:
+    with Session() as session:
+        stmt = select(CustomSummary.text).where(CustomSummary.id == custom_summary_id)
+        return session.execute(stmt).scalar_one_or_none()
+
+
+def get_custom_summaries(
+    transcription_id: int, max_age: timedelta, limit: int
+) -> list[CustomSummary]:
+    """Возвращает последние ответы к транскрипции без текста самих ответов."""
+    with Session() as session:
+        stmt = (
+            select(CustomSummary)
+            .options(defer(CustomSummary.text))
+            .where(
+                CustomSummary.transcription_id == transcription_id,
+                CustomSummary.used_at > func.now() - max_age,
+            )
+            .order_by(CustomSummary.used_at.desc())
+            .limit(limit)
+        )
+        return list(session.execute(stmt).scalars())
+
+
+def touch_custom_summary(custom_summary_id: int) -> None:
+    with Session() as session:
+        try:
+            stmt = (
+                update(CustomSummary)
+                .where(CustomSummary.id == custom_summary_id)
+                .values(used_at=func.now())
             )
             session.execute(stmt)
         except:
@@ -129,3 +519,232 @@ def save_summary(text: str, transcription_id: int, prompt_id: int) -> None:
             raise
         else:
             session.commit()
+
+
+def save_custom_summary(
+    transcription_id: int, prompt: str, prompt_hash: str, text: str
+) -> None:
+    with Session() as session:
+        try:
+            stmt = (
+                insert(CustomSummary)
+                .values(
+                    transcription_id=transcription_id,
+                    prompt=prompt,
+                    prompt_hash=prompt_hash,
+                    text=text,
+                    used_at=func.now(),
+                )
+                .on_conflict_do_update(
+                    set_=dict(text=text, used_at=func.now(), updated_at=func.now()),
+                    index_elements=["transcription_id", "prompt_hash"],
+                )
+            )
+            session.execute(stmt)
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+
+def evict_custom_summaries(max_age: timedelta, max_count: int) -> int:
+    """Удаляет устаревшие ответы и самые давно использованные сверх max_count."""
+    with Session() as session:
+        try:
+            expired = session.execute(
+                delete(CustomSummary).where(
+                    CustomSummary.used_at < func.now() - max_age
+                )
+            ).rowcount
+
+            extra = (
+                select(CustomSummary.id)
+                .order_by(CustomSummary.used_at.desc())
+                .offset(max_count)
+            )
+            evicted = session.execute(
+                delete(CustomSummary).where(CustomSummary.id.in_(extra))
+            ).rowcount
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return expired + evicted
+
+
+JOB_PENDING = "pending"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS") or 3)
+
+
+def enqueue_job(
+    message: types.Message, bot_message_id: int, max_attempts: int = JOB_MAX_ATTEMPTS
+) -> int:
+    with Session() as session:
+        try:
+            stmt = (
+                insert(Job)
+                .values(
+                    status=JOB_PENDING,
+                    chat_id=message.chat.id,
+                    bot_message_id=bot_message_id,
+                    message=message.json,
+                    max_attempts=max_attempts,
+                )
+                .returning(Job.id)
+            )
+            job_id = session.execute(stmt).scalar_one()
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return job_id
+
+
+def claim_job(visibility_timeout: int) -> Optional[Job]:
+    """Забирает следующее задание из очереди.
+
+    Задание, которое обрабатывал упавший или зависший воркер, снова становится
+    доступным, когда истекает его locked_until.
+    """
+    with Session(expire_on_commit=False) as session:
+        try:
+            stmt = (
+                select(Job)
+                .where(
+                    or_(
+                        and_(Job.status == JOB_PENDING, Job.available_at <= func.now()),
+                        and_(
+                            Job.status == JOB_PROCESSING, Job.locked_until < func.now()
+                        ),
+                    )
+                )
+                .order_by(Job.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            job = session.execute(stmt).scalar_one_or_none()
+            if job is None:
+                return None
+
+            job.status = JOB_PROCESSING
+            job.attempts += 1
+            job.locked_until = func.now() + timedelta(seconds=visibility_timeout)
+            session.flush()
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return job
+
+
+def extend_job(job_id: int, visibility_timeout: int) -> None:
+    with Session() as session:
+        try:
+            stmt = (
+                update(Job)
+                .where(Job.id == job_id, Job.status == JOB_PROCESSING)
+                .values(locked_until=func.now() + timedelta(seconds=visibility_timeout))
+            )
+            session.execute(stmt)
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+
+def complete_job(job_id: int) -> None:
+    with Session() as session:
+        try:
+            stmt = (
+                update(Job)
+                .where(Job.id == job_id)
+                .values(status=JOB_DONE, locked_until=None, error=None)
+            )
+            session.execute(stmt)
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+
+def release_job(job_id: int) -> None:
+    """Возвращает в очередь задание, прерванное остановкой воркера.
+
+    Попытка не засчитывается, задание сразу доступно другим воркерам.
+    """
+    with Session() as session:
+        try:
+            stmt = (
+                update(Job)
+                .where(Job.id == job_id, Job.status == JOB_PROCESSING)
+                .values(
+                    status=JOB_PENDING,
+                    attempts=Job.attempts - 1,
+                    locked_until=None,
+                    available_at=func.now(),
+                )
+            )
+            session.execute(stmt)
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+
+def fail_job(job: Job, error: str, retry_delay: int, retry: bool = True) -> bool:
+    """Возвращает задание в очередь, если попытки не закончились.
+
+    С retry=False задание сразу помечается неудавшимся.
+    Возвращает True, если задание будет повторено.
+    """
+    retry = retry and job.attempts < job.max_attempts
+    values = dict(status=JOB_FAILED, locked_until=None, error=error)
+    if retry:
+        values.update(
+            status=JOB_PENDING,
+            available_at=func.now() + timedelta(seconds=retry_delay * job.attempts),
+        )
+
+    with Session() as session:
+        try:
+            session.execute(update(Job).where(Job.id == job.id).values(**values))
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return retry
+
+
+def delete_finished_jobs(max_age: timedelta) -> int:
+    """Удаляет выполненные и неудавшиеся задания старше max_age."""
+    with Session() as session:
+        try:
+            deleted = session.execute(
+                delete(Job).where(
+                    Job.status.in_((JOB_DONE, JOB_FAILED)),
+                    Job.updated_at < func.now() - max_age,
+                )
+            ).rowcount
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+
+    return deleted
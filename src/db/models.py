@@ -2,7 +2,9 @@ from datetime import datetime
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
-from sqlalchemy import String, BigInteger, DateTime, Text, ForeignKey, FetchedValue
+from sqlalchemy import String, BigInteger, DateTime, Text, ForeignKey, FetchedValue, Index
+from sqlalchemy import false, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 
 
@@ -37,8 +39,12 @@ class Prompt(Base):
     __tablename__ = "prompts"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    name: Mapped[str] = mapped_column(String(128))
+    name: Mapped[str] = mapped_column(String(128), index=True)
     text: Mapped[str] = mapped_column(Text)
+    # Промпт применяется не к транскрипции, а к саммари по этому промпту
+    source_prompt_id: Mapped[int] = mapped_column(
+        ForeignKey("prompts.id", ondelete="SET NULL"), nullable=True
+    )
 
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
@@ -58,12 +64,29 @@ class Prompt(Base):
 
 class Transcription(Base):
     __tablename__ = "transcriptions"
+    __table_args__ = (
+        Index(
+            "ix_transcriptions_chat_id_message_id",
+            "chat_id",
+            "message_id",
+            unique=True,
+        ),
+        Index(
+            "ix_transcriptions_precompute_pending",
+            "id",
+            postgresql_where=text("precompute_pending"),
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     chat_id: Mapped[int] = mapped_column(BigInteger)
     message_id: Mapped[int] = mapped_column(BigInteger)
     text: Mapped[str] = mapped_column(Text)
+    file_unique_id: Mapped[str] = mapped_column(String(128), nullable=True, index=True)
+    audio_hash: Mapped[str] = mapped_column(String(64), nullable=True, index=True)
+    # Саммари из EAGER_SUMMARY_PROMPTS ещё не готовились
+    precompute_pending: Mapped[bool] = mapped_column(default=False, server_default=false())
 
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True),
@@ -82,6 +105,14 @@ class Transcription(Base):
 
 class Summary(Base):
     __tablename__ = "summaries"
+    __table_args__ = (
+        Index(
+            "ix_summaries_transcription_id_prompt_id",
+            "transcription_id",
+            "prompt_id",
+            unique=True,
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     prompt_id: Mapped[int] = mapped_column(ForeignKey("prompts.id", ondelete="CASCADE"))
@@ -105,6 +136,46 @@ class Summary(Base):
     )
 
 
+class CustomSummary(Base):
+    """Ответ LLM на произвольный запрос пользователя к транскрипции."""
+
+    __tablename__ = "custom_summaries"
+    __table_args__ = (
+        Index(
+            "ix_custom_summaries_transcription_id_prompt_hash",
+            "transcription_id",
+            "prompt_hash",
+            unique=True,
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    transcription_id: Mapped[int] = mapped_column(
+        ForeignKey("transcriptions.id", ondelete="CASCADE")
+    )
+    # Запрос после нормализации и его sha256
+    prompt: Mapped[str] = mapped_column(Text)
+    prompt_hash: Mapped[str] = mapped_column(String(64))
+    text: Mapped[str] = mapped_column(Text)
+    used_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), default=func.now(), nullable=False, index=True
+    )
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=func.now(),
+        server_default=FetchedValue(),
+        nullable=False,
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=func.now(),
+        onupdate=func.now(),
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
+
+
 class Subscription(Base):
     __tablename__ = "subscriptions"
 
@@ -125,3 +196,35 @@ class Subscription(Base):
         server_default=FetchedValue(),
         server_onupdate=FetchedValue(),
     )
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_available_at", "status", "available_at"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending")
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    bot_message_id: Mapped[int] = mapped_column(BigInteger)
+    message: Mapped[dict] = mapped_column(JSONB)
+    attempts: Mapped[int] = mapped_column(default=0)
+    max_attempts: Mapped[int] = mapped_column()
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+    available_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), default=func.now(), nullable=False
+    )
+    locked_until: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=func.now(),
+        server_default=FetchedValue(),
+        nullable=False,
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=func.now(),
+        onupdate=func.now(),
+        server_default=FetchedValue(),
+        server_onupdate=FetchedValue(),
+    )
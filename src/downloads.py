@@ -0,0 +1,150 @@
+import logging
+import aiohttp
+import asyncio
+import os
+
+from typing import Awaitable, Callable, Optional
+from src.limits import get_int_env
+from src import http_client
+from src.http_client import TELEGRAM
+
+CHUNK_SIZE = 1024 * 1024
+
+# Максимальный размер загружаемого файла, 0 - без ограничений
+max_file_size = get_int_env("MAX_FILE_SIZE_MB", 4096) * 1024 * 1024
+download_retries = get_int_env("DOWNLOAD_RETRIES", 5)
+
+
+def parse_path_map(value: str) -> list[tuple[str, str]]:
+    """Разбирает строку вида "/server/path=/local/path,/other=/mnt/other"."""
+    path_map = []
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+
+        server_path, local_path = item.split("=", 1)
+        path_map.append((server_path.strip().rstrip("/"), local_path.strip().rstrip("/")))
+
+    return path_map
+
+
+# Соответствие путей локального Bot API сервера путям, смонтированным в контейнер
+local_files_path_map = parse_path_map(os.getenv("TG_LOCAL_FILES_PATH_MAP", ""))
+
+
+class FileTooLargeError(Exception):
+    pass
+
+
+class IncompleteDownloadError(Exception):
+    pass
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadRejectedError(DownloadError):
+    """Файловый сервер ответил 4xx - повторная попытка не поможет."""
+
+
+def check_file_size(size: Optional[int], max_size: int = max_file_size) -> None:
+    if max_size and size and size > max_size:
+        raise FileTooLargeError(f"File size {size} exceeds the limit of {max_size}")
+
+
+def get_local_file_path(file_server_path: str) -> Optional[str]:
+    """Возвращает путь к файлу на общем томе, если Bot API сервер работает в режиме --local."""
+    if not os.path.isabs(file_server_path):
+        return None
+
+    local_path = file_server_path
+    for server_prefix, local_prefix in local_files_path_map:
+        if file_server_path.startswith(f"{server_prefix}/"):
+            local_path = local_prefix + file_server_path[len(server_prefix) :]
+            break
+
+    if not os.path.isfile(local_path):
+        logging.warning(f'Local file "{local_path}" not found, falling back to HTTP')
+        return None
+
+    return local_path
+
+
+def link_local_file(local_path: str, file_name: str) -> None:
+    # Жёсткая ссылка работает только в пределах одной файловой системы
+    try:
+        os.link(local_path, file_name)
+    except OSError:
+        os.symlink(os.path.abspath(local_path), file_name)
+
+
+async def download_file(
+    url: str,
+    file_name: str,
+    on_progress: Optional[Callable[[int, Optional[int]], Awaitable[None]]] = None,
+    max_size: int = max_file_size,
+) -> int:
+    """Скачивает файл по частям, докачивая его через Range при обрывах связи.
+
+    Возвращает количество скачанных байт.
+    """
+    downloaded = 0
+    total = None
+    attempt = 0
+
+    while True:
+        headers = {}
+        if downloaded:
+            headers["Range"] = f"bytes={downloaded}-"
+
+        try:
+            async with http_client.request(
+                TELEGRAM, "GET", url, endpoint="/file", headers=headers
+            ) as response:
+                if response.status == 416 and total == downloaded:
+                    return downloaded
+
+                if response.status >= 400:
+                    # В тексте ошибки aiohttp есть URL с токеном бота
+                    error = f"File server responded with {response.status}"
+                    if response.status < 500:
+                        raise DownloadRejectedError(error)
+                    raise IncompleteDownloadError(error)
+
+                if downloaded and response.status != 206:
+                    # Сервер не поддерживает Range - начинаем сначала
+                    logging.warning("Range is not supported, restarting download")
+                    downloaded = 0
+
+                if response.content_length is not None:
+                    total = downloaded + response.content_length
+                check_file_size(total, max_size)
+
+                with open(file_name, "ab" if downloaded else "wb") as file:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        file.write(chunk)
+                        downloaded += len(chunk)
+                        check_file_size(downloaded, max_size)
+
+                        if on_progress:
+                            await on_progress(downloaded, total)
+
+            if total is not None and downloaded < total:
+                raise IncompleteDownloadError(
+                    f"Downloaded {downloaded} of {total} bytes"
+                )
+
+            return downloaded
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownloadError) as e:
+            attempt += 1
+            if attempt > download_retries:
+                raise DownloadError(
+                    f"Download failed at {downloaded} bytes: {type(e).__name__}"
+                ) from None
+
+            logging.warning(
+                f"Download interrupted at {downloaded} bytes, retry {attempt}: {type(e).__name__}"
+            )
+            await asyncio.sleep(min(2**attempt, 30))
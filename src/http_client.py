@@ -0,0 +1,160 @@
+import threading
+import aiohttp
+import asyncio
+import logging
+import random
+import time
+import os
+
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from typing import AsyncIterator, Optional
+from src.limits import get_int_env
+from src import aio
+
+WHISPERX = "whisperx"
+LLM = "llm"
+TELEGRAM = "telegram"
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT") or 10)
+
+# Таймауты чтения по сервисам, в секундах
+READ_TIMEOUTS = {
+    WHISPERX: float(os.getenv("WHISPERX_TIMEOUT") or 300),
+    LLM: float(os.getenv("LLM_TIMEOUT") or 600),
+    TELEGRAM: float(os.getenv("TG_FILES_TIMEOUT") or 60),
+}
+
+# Методы, которые безопасно повторять при ответах 502/503/504 и обрывах соединения.
+# Запрос к LLM можно повторить, а повторная отправка файла в WhisperX создаст второе задание
+RETRY_METHODS = {
+    WHISPERX: frozenset({"GET", "HEAD"}),
+    LLM: frozenset({"GET", "HEAD", "POST"}),
+    TELEGRAM: frozenset({"GET", "HEAD"}),
+}
+RETRY_STATUSES = (502, 503, 504)
+
+POOL_SIZE = get_int_env("HTTP_POOL_SIZE", 10)
+KEEPALIVE_TIMEOUT = get_int_env("HTTP_KEEPALIVE_TIMEOUT", 60)
+RETRIES = get_int_env("HTTP_RETRIES", 3)
+METRICS_INTERVAL = get_int_env("HTTP_METRICS_INTERVAL", 300)
+
+sessions: dict[str, aiohttp.ClientSession] = {}
+
+metrics: dict[tuple[str, str], dict] = {}
+metrics_lock = threading.Lock()
+
+
+def get_session(service: str) -> aiohttp.ClientSession:
+    # Сессии привязаны к общему циклу событий, поэтому создаются только в нём
+    session = sessions.get(service)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT
+            ),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUTS[service]
+            ),
+        )
+        sessions[service] = session
+
+    return session
+
+
+async def close_sessions() -> None:
+    for session in sessions.values():
+        await session.close()
+    sessions.clear()
+
+
+def record_latency(service: str, endpoint: str, elapsed: float, failed: bool) -> None:
+    with metrics_lock:
+        item = metrics.setdefault(
+            (service, endpoint),
+            {"count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0},
+        )
+        item["count"] += 1
+        item["total_time"] += elapsed
+        item["max_time"] = max(item["max_time"], elapsed)
+        if failed:
+            item["errors"] += 1
+
+
+def get_retry_delay(attempt: int) -> float:
+    return 0.5 * 2 ** (attempt - 1) + random.uniform(0, 0.5)
+
+
+@asynccontextmanager
+async def request(
+    service: str,
+    method: str,
+    url: str,
+    endpoint: Optional[str] = None,
+    retries: Optional[int] = None,
+    **kwargs,
+) -> AsyncIterator[aiohttp.ClientResponse]:
+    """Выполняет запрос через общий пул соединений сервиса.
+
+    endpoint - имя для метрик; по умолчанию берётся путь из url, поэтому для
+    адресов с токеном или идентификатором файла его нужно передать явно.
+    Неудачные попытки повторяются с экспоненциальной задержкой и случайным
+    разбросом, но только если метод безопасно повторять.
+    """
+    endpoint = endpoint or urlparse(url).path
+    retries = RETRIES if retries is None else retries
+    retryable = method in RETRY_METHODS[service]
+
+    attempt = 0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        try:
+            response = await get_session(service).request(method, url, **kwargs)
+        except aiohttp.ClientConnectorError:
+            # Соединение не установлено, запрос точно не отправлен
+            record_latency(service, endpoint, time.monotonic() - started, True)
+            if attempt > retries:
+                raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            record_latency(service, endpoint, time.monotonic() - started, True)
+            if not retryable or attempt > retries:
+                raise
+        else:
+            failed = response.status >= 500
+            record_latency(service, endpoint, time.monotonic() - started, failed)
+
+            if response.status in RETRY_STATUSES and retryable and attempt <= retries:
+                response.release()
+            else:
+                try:
+                    yield response
+                finally:
+                    response.release()
+                return
+
+        await asyncio.sleep(get_retry_delay(attempt))
+
+
+def log_metrics() -> None:
+    with metrics_lock:
+        items = sorted(metrics.items())
+
+    for (service, endpoint), item in items:
+        logging.info(
+            f"HTTP {service} {endpoint}: {item['count']} requests, "
+            f"{item['errors']} errors, "
+            f"avg {item['total_time'] / item['count'] * 1000:.0f}ms, "
+            f"max {item['max_time'] * 1000:.0f}ms"
+        )
+
+
+async def log_metrics_periodically() -> None:
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        log_metrics()
+
+
+def start_metrics_logger() -> None:
+    if METRICS_INTERVAL:
+        aio.submit(log_metrics_periodically())
@@ -0,0 +1,152 @@
+from dotenv import load_dotenv
+from contextvars import ContextVar
+import asyncio
+import heapq
+import itertools
+import os
+
+load_dotenv()
+
+
+def get_int_env(name: str, default: int) -> int:
+    value = os.getenv(name)
+    if not value:
+        return default
+
+    return int(value)
+
+
+# Ограничения на количество одновременно выполняемых этапов обработки
+download_limit = asyncio.BoundedSemaphore(max(1, get_int_env("DOWNLOAD_CONCURRENCY", 4)))
+transcode_limit = asyncio.BoundedSemaphore(max(1, get_int_env("TRANSCODE_CONCURRENCY", 2)))
+# По умолчанию - по одной транскрипции на каждый сервер WhisperX
+whisperx_backends_count = len(
+    [url for url in (os.getenv("WHISPERX_API_ADDRESS") or "").split(",") if url.strip()]
+)
+transcription_concurrency = max(
+    1, get_int_env("TRANSCRIPTION_CONCURRENCY", whisperx_backends_count)
+)
+transcription_limit = asyncio.BoundedSemaphore(transcription_concurrency)
+
+# Количество заданий, которые процесс обрабатывает одновременно. По умолчанию
+# вдвое больше транскрипций: пока одни распознаются, другие скачиваются.
+# Больше брать не стоит - лишние задания ждали бы очереди на распознавание
+# заблокированными, хотя их могли бы взять другие воркеры
+workers_count = max(1, get_int_env("WORKERS_COUNT", transcription_concurrency * 2))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+priority_limits: list["PriorityLimit"] = []
+
+
+class Priority:
+    """Приоритет задачи, который можно поднять, пока она ждёт места.
+
+    Общую для нескольких запросов задачу поднимают до самого срочного
+    из ждущих, а вместе с ней - задачи, результата которых ждёт она сама.
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        self.dependencies: list["Priority"] = []
+
+    def raise_to(self, value: int) -> None:
+        if value >= self.value:
+            return
+
+        self.value = value
+        for limit in priority_limits:
+            limit.reorder()
+        for dependency in self.dependencies:
+            dependency.raise_to(value)
+
+    def add_dependency(self, dependency: "Priority") -> None:
+        dependency.raise_to(self.value)
+        # Выше интерактивного приоритета подниматься некуда
+        if self.value != INTERACTIVE:
+            self.dependencies.append(dependency)
+
+
+# Приоритет запросов текущей задачи; наследуется задачами, созданными из неё
+priority = ContextVar("priority", default=Priority(INTERACTIVE))
+
+
+class PriorityLimit:
+    """Семафор, который пускает задачи в порядке приоритета.
+
+    Фоновые задачи занимают место, только если его не ждёт ни одна
+    интерактивная, и не больше value - reserved мест, чтобы у
+    интерактивных всегда оставалось свободное.
+    """
+
+    def __init__(self, value: int, reserved: int = 0):
+        self.value = value
+        self.reserved = min(reserved, value - 1)
+        self.in_use = 0
+        self.waiters: list[tuple[int, int, asyncio.Future, Priority]] = []
+        self.counter = itertools.count()
+        priority_limits.append(self)
+
+    def fits(self, task_priority: int) -> bool:
+        if task_priority == INTERACTIVE:
+            return self.in_use < self.value
+
+        return self.in_use < self.value - self.reserved
+
+    def wake_up(self) -> None:
+        while self.waiters:
+            task_priority, _, future, _ = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self.fits(task_priority):
+                break
+
+            heapq.heappop(self.waiters)
+            self.in_use += 1
+            future.set_result(None)
+
+    def reorder(self) -> None:
+        # Приоритет кого-то из ждущих подняли
+        self.waiters = [
+            (task_priority.value, number, future, task_priority)
+            for _, number, future, task_priority in self.waiters
+        ]
+        heapq.heapify(self.waiters)
+        self.wake_up()
+
+    async def acquire(self) -> None:
+        task_priority = priority.get()
+        if not self.waiters and self.fits(task_priority.value):
+            self.in_use += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self.waiters,
+            (task_priority.value, next(self.counter), future, task_priority),
+        )
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self.wake_up()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *args):
+        self.release()
+
+
+# Сколько запросов к LLM выполняется одновременно - по числу слотов сервера
+llm_concurrency = max(1, get_int_env("LLM_CONCURRENCY", 1))
+# Сколько из них не отдаются фоновым запросам
+llm_interactive_slots = get_int_env("LLM_INTERACTIVE_SLOTS", 1)
+llm_limit = PriorityLimit(llm_concurrency, llm_interactive_slots)
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+import os
+
+from typing import Awaitable, Callable, Coroutine, Hashable, Optional
+from src.limits import get_int_env, llm_concurrency
+from src.utils import md_to_text, limit_text
+from src.summarization import summarize, get_prompt_summary
+from src.db.models import Transcription, Prompt
+from src import aio
+
+# Сколько запросов может ждать в очереди, остальным сразу отказываем
+LLM_QUEUE_SIZE = max(1, get_int_env("LLM_QUEUE_SIZE", 100))
+# Как часто обновлять сообщение во время генерации, в секундах.
+# Telegram ограничивает частоту редактирования сообщений в одном чате
+STREAM_EDIT_INTERVAL = float(os.getenv("LLM_STREAM_EDIT_INTERVAL") or 3)
+
+queue: Optional[asyncio.Queue] = None
+workers: list[asyncio.Task] = []
+pending_keys: set[Hashable] = set()
+
+
+class QueueFullError(Exception):
+    pass
+
+
+async def run_llm_jobs() -> None:
+    while True:
+        job = await queue.get()
+        try:
+            await job
+        except Exception as e:
+            logging.error(e)
+        finally:
+            queue.task_done()
+
+
+async def put(job: Coroutine) -> None:
+    global queue
+
+    if queue is None:
+        queue = asyncio.Queue(LLM_QUEUE_SIZE)
+        for _ in range(llm_concurrency):
+            workers.append(asyncio.create_task(run_llm_jobs()))
+
+    try:
+        queue.put_nowait(job)
+    except asyncio.QueueFull:
+        job.close()
+        raise QueueFullError()
+
+
+def get_progress_reporter(
+    on_progress: Callable[[str], None],
+) -> Callable[[str], Awaitable]:
+    # Первый кусок показываем сразу - ради него потоковый режим и нужен
+    last_update = 0.0
+    last_text = ""
+
+    async def report(content: str) -> None:
+        nonlocal last_update, last_text
+        if time.monotonic() - last_update < STREAM_EDIT_INTERVAL:
+            return
+
+        text = limit_text(md_to_text(content))
+        if text.strip() == last_text.strip():
+            return
+
+        last_update = time.monotonic()
+        last_text = text
+        try:
+            await asyncio.to_thread(on_progress, text)
+        except Exception as e:
+            logging.warning(f"Unable to show partial LLM response: {e}")
+
+    return report
+
+
+async def run_summary(
+    generate: Callable[[Optional[Callable[[str], Awaitable]]], Awaitable[str]],
+    on_result: Callable[[str], None],
+    on_error: Callable[[], None],
+    on_progress: Optional[Callable[[str], None]],
+    key: Optional[Hashable],
+) -> None:
+    on_partial = get_progress_reporter(on_progress) if on_progress else None
+    try:
+        try:
+            content = await generate(on_partial)
+        except Exception as e:
+            logging.error(e)
+            await asyncio.to_thread(on_error)
+            return
+
+        # Обработчики результата работают с синхронным ботом и базой
+        await asyncio.to_thread(on_result, content)
+    finally:
+        pending_keys.discard(key)
+
+
+def enqueue(
+    generate: Callable[[Optional[Callable[[str], Awaitable]]], Awaitable[str]],
+    on_result: Callable[[str], None],
+    on_error: Callable[[], None],
+    on_progress: Optional[Callable[[str], None]] = None,
+    key: Optional[Hashable] = None,
+) -> bool:
+    """Ставит запрос к LLM в очередь и сразу возвращает управление.
+
+    generate получает функцию для частичного результата и возвращает текст.
+    on_result получает готовый текст, on_error вызывается при ошибке,
+    on_progress - уже сгенерированную часть текста не чаще раза в
+    STREAM_EDIT_INTERVAL секунд; все они выполняются в отдельном потоке.
+    Если задание с тем же key ещё не выполнено, новое не ставится и
+    возвращается False. При переполненной очереди выбрасывается QueueFullError.
+    """
+
+    async def add() -> bool:
+        if key is not None and key in pending_keys:
+            return False
+
+        await put(run_summary(generate, on_result, on_error, on_progress, key))
+        if key is not None:
+            pending_keys.add(key)
+        return True
+
+    return aio.run_sync(add())
+
+
+def enqueue_summary(
+    text: str,
+    system_prompt: str,
+    on_result: Callable[[str], None],
+    on_error: Callable[[], None],
+    on_progress: Optional[Callable[[str], None]] = None,
+    key: Optional[Hashable] = None,
+) -> bool:
+    """Обрабатывает text произвольным запросом пользователя, см. enqueue."""
+
+    async def generate(on_partial):
+        return md_to_text(await summarize(text, system_prompt, on_partial=on_partial))
+
+    return enqueue(generate, on_result, on_error, on_progress, key)
+
+
+def enqueue_prompt_summary(
+    transcription: Transcription,
+    prompt: Prompt,
+    on_result: Callable[[str], None],
+    on_error: Callable[[], None],
+    on_progress: Optional[Callable[[str], None]] = None,
+    key: Optional[Hashable] = None,
+) -> bool:
+    """Готовит саммари по сохранённому промпту, см. enqueue.
+
+    Результат и саммари, от которых он зависит, сохраняются в базу.
+    """
+
+    async def generate(on_partial):
+        return await get_prompt_summary(transcription, prompt, on_partial=on_partial)
+
+    return enqueue(generate, on_result, on_error, on_progress, key)
@@ -49,6 +49,22 @@ You can copy and forward each item as a message or download it as a file!""",
         "default": "Processing has been started",
         "ru": "Запускаем обработку",
     },
+    "downloading_file": {
+        "default": "Downloading the file: {percent}%",
+        "ru": "Загружаем файл: {percent}%",
+    },
+    "file_too_large": {
+        "default": "The file is too large",
+        "ru": "Файл слишком большой",
+    },
+    "llm_queue_full": {
+        "default": "Too many requests right now, please try again in a few minutes",
+        "ru": "Сейчас слишком много запросов, попробуйте через несколько минут",
+    },
+    "summarization_in_progress": {
+        "default": "Processing is already in progress",
+        "ru": "Обработка уже идёт",
+    },
     "processing_error": {
         "default": "Audio processing error",
         "ru": "Ошибка обработки аудио",
@@ -0,0 +1,262 @@
+import logging
+import asyncio
+import json
+import time
+import re
+
+from subprocess import CompletedProcess
+from typing import Optional
+
+# Кодеки, которые WhisperX принимает без перекодирования, и контейнер для копирования потока
+COPY_CODECS = {
+    "aac": "m4a",
+    "mp3": "mp3",
+    "opus": "ogg",
+    "vorbis": "ogg",
+    "flac": "flac",
+}
+
+# WhisperX всё равно приводит звук к 16 кГц моно
+SAMPLE_RATE = 16000
+
+
+class NoAudioStreamError(Exception):
+    pass
+
+
+class MediaProcessingError(Exception):
+    pass
+
+
+def is_url(file_name: str) -> bool:
+    return file_name.startswith("http://") or file_name.startswith("https://")
+
+
+def get_input_options(input_file: str) -> list[str]:
+    if not is_url(input_file):
+        return []
+
+    # ffmpeg сам переподключается и докачивает через Range при обрывах
+    return [
+        "-reconnect",
+        "1",
+        "-reconnect_on_network_error",
+        "1",
+        "-reconnect_delay_max",
+        "10",
+    ]
+
+
+async def run_tool(args: list[str]) -> CompletedProcess:
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+
+    result = CompletedProcess(
+        args,
+        process.returncode,
+        stdout.decode(errors="replace"),
+        stderr.decode(errors="replace"),
+    )
+
+    # В аргументах может быть URL с токеном бота, поэтому ни команду,
+    # ни упоминания URL в выводе в логи не пишем
+    if result.returncode != 0:
+        stderr = result.stderr
+        for arg in args:
+            if is_url(arg):
+                stderr = stderr.replace(arg, "<url>")
+
+        raise MediaProcessingError(
+            f"{args[0]} exited with code {result.returncode}: {stderr.strip()}"
+        )
+
+    return result
+
+
+async def probe(file_name: str) -> dict:
+    result = await run_tool(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            *get_input_options(file_name),
+            "-show_entries",
+            "format=format_name,duration:stream=index,codec_type,codec_name,sample_rate,channels:stream_disposition=attached_pic",
+            "-of",
+            "json",
+            file_name,
+        ]
+    )
+
+    return json.loads(result.stdout)
+
+
+async def get_duration(file_name: str) -> Optional[float]:
+    duration = (await probe(file_name)).get("format", {}).get("duration")
+    if duration is None:
+        return None
+
+    return float(duration)
+
+
+def get_audio_stream(info: dict) -> Optional[dict]:
+    for stream in info.get("streams", []):
+        if stream.get("codec_type") == "audio":
+            return stream
+
+    return None
+
+
+def has_video_stream(info: dict) -> bool:
+    for stream in info.get("streams", []):
+        # Обложки mp3/m4a ffprobe тоже показывает как видеопоток
+        if (
+            stream.get("codec_type") == "video"
+            and not stream.get("disposition", {}).get("attached_pic")
+        ):
+            return True
+
+    return False
+
+
+async def copy_audio(input_file: str, output_file: str) -> None:
+    await run_tool(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-y",
+            *get_input_options(input_file),
+            "-i",
+            input_file,
+            "-map",
+            "0:a:0",
+            "-vn",
+            "-sn",
+            "-dn",
+            "-c:a",
+            "copy",
+            output_file,
+        ]
+    )
+
+
+async def downmix_audio(
+    input_file: str,
+    output_file: str,
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+) -> None:
+    position = []
+    if start is not None:
+        position += ["-ss", f"{start:.3f}"]
+    if end is not None:
+        position += ["-to", f"{end:.3f}"]
+
+    await run_tool(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-y",
+            *get_input_options(input_file),
+            *position,
+            "-i",
+            input_file,
+            "-map",
+            "0:a:0",
+            "-vn",
+            "-sn",
+            "-dn",
+            "-ac",
+            "1",
+            "-ar",
+            str(SAMPLE_RATE),
+            "-c:a",
+            "flac",
+            output_file,
+        ]
+    )
+
+
+async def extract_audio(input_file: str, output_base: str) -> str:
+    """Готовит звуковую дорожку для WhisperX и возвращает путь к ней.
+
+    Если файл уже содержит только звук в подходящем кодеке, ffmpeg не запускается.
+    Подходящий кодек копируется из контейнера без перекодирования, остальные
+    сразу сводятся в 16 кГц моно. Вместо пути можно передать URL - тогда ffmpeg
+    читает файл по сети и на диск попадает только звуковая дорожка.
+    """
+    started = time.monotonic()
+    info = await probe(input_file)
+
+    audio_stream = get_audio_stream(info)
+    if audio_stream is None:
+        raise NoAudioStreamError("No audio stream found")
+
+    codec = audio_stream.get("codec_name")
+    method = "downmix"
+    output_file = f"{output_base}.flac"
+
+    if codec in COPY_CODECS and not has_video_stream(info) and not is_url(input_file):
+        method = "as is"
+        output_file = input_file
+    elif codec in COPY_CODECS:
+        method = "stream copy"
+        output_file = f"{output_base}.{COPY_CODECS[codec]}"
+        try:
+            await copy_audio(input_file, output_file)
+        except Exception as e:
+            logging.warning(f"Stream copy of {codec} failed, downmixing: {e}")
+            method = "downmix"
+            output_file = f"{output_base}.flac"
+            await downmix_audio(input_file, output_file)
+    else:
+        await downmix_audio(input_file, output_file)
+
+    logging.info(
+        f"Audio extraction ({method}, codec {codec}) took {time.monotonic() - started:.2f}s"
+    )
+
+    return output_file
+
+
+async def detect_silences(
+    file_name: str, noise_db: int = -35, min_duration: float = 0.5
+) -> list[tuple[float, float]]:
+    """Возвращает список пауз (начало, конец) в секундах."""
+    result = await run_tool(
+        [
+            "ffmpeg",
+            "-v",
+            "info",
+            "-nostats",
+            "-i",
+            file_name,
+            "-vn",
+            "-af",
+            f"silencedetect=noise={noise_db}dB:d={min_duration}",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+
+    silences = []
+    start = None
+    for line in result.stderr.splitlines():
+        if match := re.search(r"silence_start: (-?[\d.]+)", line):
+            start = max(0.0, float(match.group(1)))
+        elif (match := re.search(r"silence_end: ([\d.]+)", line)) and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+
+    return silences
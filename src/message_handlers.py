@@ -2,21 +2,22 @@ from telebot.util import quick_markup
 from src.localization import get_localized, get_language_code
 from src.utils import (
     get_file_name,
-    md_to_text,
-    generate_summary,
     limit_text,
     get_full_completed_text,
 )
+from src.llm_queue import enqueue_summary, enqueue_prompt_summary, QueueFullError
+from src.custom_summaries import find_custom_summary, remember_custom_summary
+from src.user_registry import register_user
 from src.db.db import (
-    register_user,
     get_transcription,
-    get_summary,
-    get_prompt_by_name,
-    save_summary,
+    get_transcription_text,
+    get_transcription_with_summary,
+    enqueue_job,
+    session_scope,
 )
+from src.prompt_registry import get_prompt_by_name
 
 import telebot
-import queue
 import os
 import logging
 
@@ -53,8 +54,9 @@ def get_text_processing_markup(language_code: str, text_type: str):
     )
 
 
-def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
+def add_handlers(bot: telebot.TeleBot):
     @bot.message_handler(content_types=["audio", "voice", "video", "document"])
+    @session_scope()
     def add_to_queue(message):
         register_user(message)
         code = get_language_code(message)
@@ -63,9 +65,10 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
             get_localized("file_added_to_queue", code),
             reply_to_message_id=message.id,
         )
-        q.put({"bot": bot, "message": message, "bot_message_id": msg.id})
+        enqueue_job(message, msg.id)
 
     @bot.message_handler(commands=["start", "help"])
+    @session_scope()
     def send_welcome(message):
         register_user(message)
         code = get_language_code(message)
@@ -100,6 +103,7 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
         )
 
     @bot.callback_query_handler(func=lambda call: call.data == "show_transcription")
+    @session_scope()
     def handle_button_click(call):
         msg: telebot.types.Message = call.message
         text_type = "transcription"
@@ -128,6 +132,7 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
             bot.answer_callback_query(call.id, f"{text_type} not found")
 
     @bot.callback_query_handler(func=lambda call: call.data == "download_transcription")
+    @session_scope()
     def handle_button_click(call):
         msg: telebot.types.Message = call.message
         text_type = "transcription"
@@ -176,13 +181,78 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
             except:
                 logging.error(f'Error removing file "{file_name}"')
 
+    def start_summarization(
+        call, transcription, prompt, on_result, markup, on_progress=None
+    ) -> None:
+        msg: telebot.types.Message = call.message
+        code = get_language_code(msg)
+
+        def on_error():
+            bot.edit_message_text(
+                chat_id=msg.chat.id,
+                message_id=msg.id,
+                text=get_localized("unknown_error", code),
+                reply_markup=markup,
+            )
+
+        def restore_message():
+            try:
+                bot.edit_message_text(
+                    chat_id=msg.chat.id,
+                    message_id=msg.id,
+                    text=msg.text,
+                    reply_markup=msg.reply_markup,
+                )
+            except Exception as e:
+                logging.error(e)
+
+        # Сообщение меняется до постановки в очередь: готовое саммари может
+        # прийти раньше, чем отсюда вернётся управление
+        bot.edit_message_text(
+            chat_id=msg.chat.id,
+            message_id=msg.id,
+            text=get_localized("start_summarization", code),
+        )
+
+        try:
+            started = enqueue_prompt_summary(
+                transcription,
+                prompt,
+                on_result,
+                on_error,
+                on_progress=on_progress,
+                key=(msg.chat.id, msg.id),
+            )
+        except QueueFullError:
+            restore_message()
+            bot.answer_callback_query(call.id, get_localized("llm_queue_full", code))
+            return
+
+        if not started:
+            restore_message()
+            bot.answer_callback_query(
+                call.id, get_localized("summarization_in_progress", code)
+            )
+
     @bot.callback_query_handler(func=lambda call: call.data.startswith("show_"))
+    @session_scope()
     def handle_button_click(call):
         msg: telebot.types.Message = call.message
         text_type = call.data.replace("show_", "", 1)
         code = get_language_code(msg)
         markup = get_text_processing_markup(code, text_type)
 
+        def show_content(content):
+            limited_text = limit_text(content)
+
+            if msg.text.strip() != limited_text.strip():
+                bot.edit_message_text(
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.message_id,
+                    text=limited_text,
+                    reply_markup=markup,
+                )
+
         try:
             prompt = get_prompt_by_name(text_type)
             if prompt == None:
@@ -191,39 +261,26 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
                 )
                 return
 
-            transcription = get_transcription(msg.id, msg.chat.id)
-            if transcription is None:
+            found = get_transcription_with_summary(msg.id, msg.chat.id, prompt.id)
+            if found is None:
                 bot.answer_callback_query(
                     call.id, "the transcription for this message not found"
                 )
                 return
 
-            summary = get_summary(transcription.id, prompt_id=prompt.id)
-            content = ""
-            if summary is None:
-                bot.edit_message_text(
-                    chat_id=msg.chat.id,
-                    message_id=msg.id,
-                    text=get_localized("start_summarization", code),
-                )
-
-                content = generate_summary(
-                    text=transcription.text, system_prompt=prompt.text
-                )
-                content = md_to_text(content)
-                save_summary(content, transcription.id, prompt.id)
-            else:
-                content = summary.text
-
-            limited_text = limit_text(content)
+            transcription, summary = found
+            if summary is not None:
+                show_content(summary.text)
+                return
 
-            if msg.text.strip() != limited_text.strip():
+            def on_progress(text):
                 bot.edit_message_text(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=limited_text,
-                    reply_markup=markup,
+                    chat_id=msg.chat.id, message_id=msg.id, text=text
                 )
+
+            start_summarization(
+                call, transcription, prompt, show_content, markup, on_progress
+            )
         except Exception as e:
             logging.error(e)
             bot.edit_message_text(
@@ -234,6 +291,7 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
             )
 
     @bot.callback_query_handler(func=lambda call: call.data.startswith("download_"))
+    @session_scope()
     def handle_button_click(call):
         msg: telebot.types.Message = call.message
         text_type = call.data.replace("download_", "", 1)
@@ -241,6 +299,33 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
         code = get_language_code(msg)
         markup = get_text_processing_markup(code, text_type)
 
+        def send_content(content):
+            try:
+                with open(file_name, "w", encoding="utf-8") as f:
+                    f.write(content)
+
+                with open(file_name, "rt", encoding="utf-8") as file:
+                    original_message = msg.reply_to_message
+                    if original_message != None:
+                        bot.send_document(
+                            msg.chat.id, file, reply_to_message_id=original_message.id
+                        )
+                    else:
+                        bot.send_document(msg.chat.id, file, reply_to_message_id=msg.id)
+
+                # send default text_type message and keyboard
+                bot.edit_message_text(
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.message_id,
+                    text=get_localized(text_type, code),
+                    reply_markup=markup,
+                )
+            finally:
+                try:
+                    os.remove(file_name)
+                except:
+                    logging.error(f'Error removing file "{file_name}"')
+
         try:
             prompt = get_prompt_by_name(text_type)
             if prompt == None:
@@ -249,49 +334,19 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
                 )
                 return
 
-            transcription = get_transcription(msg.id, msg.chat.id)
-            if transcription is None:
+            found = get_transcription_with_summary(msg.id, msg.chat.id, prompt.id)
+            if found is None:
                 bot.answer_callback_query(
                     call.id, get_localized("transcription_not_found", code)
                 )
                 return
 
-            summary = get_summary(transcription.id, prompt_id=prompt.id)
-            content = ""
-            if summary is None:
-                bot.edit_message_text(
-                    chat_id=msg.chat.id,
-                    message_id=msg.id,
-                    text=get_localized("start_summarization", code),
-                )
-
-                content = generate_summary(
-                    text=transcription.text, system_prompt=prompt.text
-                )
-                content = md_to_text(content)
-                save_summary(content, transcription.id, prompt.id)
-            else:
-                content = summary.text
-
-            with open(file_name, "w", encoding="utf-8") as f:
-                f.write(content)
-
-            with open(file_name, "rt", encoding="utf-8") as file:
-                original_message = msg.reply_to_message
-                if original_message != None:
-                    bot.send_document(
-                        msg.chat.id, file, reply_to_message_id=original_message.id
-                    )
-                else:
-                    bot.send_document(msg.chat.id, file, reply_to_message_id=msg.id)
+            transcription, summary = found
+            if summary is not None:
+                send_content(summary.text)
+                return
 
-            # send default text_type message and keyboard
-            bot.edit_message_text(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=get_localized(text_type, code),
-                reply_markup=markup,
-            )
+            start_summarization(call, transcription, prompt, send_content, markup)
         except:
             bot.edit_message_text(
                 chat_id=msg.chat.id,
@@ -299,13 +354,9 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
                 text=get_localized("unknown_error", code),
                 reply_markup=markup,
             )
-        finally:
-            try:
-                os.remove(file_name)
-            except:
-                logging.error(f'Error removing file "{file_name}"')
 
     @bot.message_handler()
+    @session_scope()
     def handle_message(message: telebot.types.Message):
         if message.reply_to_message is None:
             return
@@ -314,29 +365,74 @@ def add_handlers(bot: telebot.TeleBot, q: queue.Queue):
         new_msg = None
 
         try:
+            # Текст транскрипции нужен, только если ответа ещё нет в кэше
             transcription = get_transcription(
-                message.reply_to_message.id, message.chat.id
+                message.reply_to_message.id, message.chat.id, with_text=False
             )
             transcription_text = message.reply_to_message.text
-            if transcription:
-                transcription_text = transcription.text
 
             prompt = message.text
 
+            if transcription:
+                cached = find_custom_summary(transcription.id, prompt)
+                if cached is not None:
+                    bot.send_message(
+                        message.chat.id,
+                        reply_to_message_id=message.id,
+                        text=limit_text(cached),
+                    )
+                    return
+
+                transcription_text = (
+                    get_transcription_text(transcription.id) or transcription_text
+                )
+
             new_msg = bot.send_message(
                 message.chat.id,
                 reply_to_message_id=message.id,
                 text=get_localized("start_summarization", code),
             )
 
-            summary = generate_summary(transcription_text, prompt)
-            summary = md_to_text(summary)
+            shown_text = ""
 
-            bot.edit_message_text(
-                chat_id=new_msg.chat.id,
-                message_id=new_msg.message_id,
-                text=limit_text(summary),
-            )
+            def on_progress(text):
+                nonlocal shown_text
+                bot.edit_message_text(
+                    chat_id=new_msg.chat.id, message_id=new_msg.message_id, text=text
+                )
+                shown_text = text
+
+            def on_result(summary):
+                if transcription:
+                    remember_custom_summary(transcription.id, prompt, summary)
+
+                # Telegram не даёт отредактировать сообщение без изменений
+                if limit_text(summary).strip() == shown_text.strip():
+                    return
+
+                bot.edit_message_text(
+                    chat_id=new_msg.chat.id,
+                    message_id=new_msg.message_id,
+                    text=limit_text(summary),
+                )
+
+            def on_error():
+                bot.edit_message_text(
+                    chat_id=new_msg.chat.id,
+                    message_id=new_msg.message_id,
+                    text=get_localized("unknown_error", code),
+                )
+
+            try:
+                enqueue_summary(
+                    transcription_text, prompt, on_result, on_error, on_progress
+                )
+            except QueueFullError:
+                bot.edit_message_text(
+                    chat_id=new_msg.chat.id,
+                    message_id=new_msg.message_id,
+                    text=get_localized("llm_queue_full", code),
+                )
 
         except Exception as e:
             logging.error(e)
@@ -0,0 +1,439 @@
+import os
+import time
+import telebot
+import asyncio
+import shutil
+import logging
+
+from concurrent.futures import Future
+from datetime import timedelta
+from telebot.async_telebot import AsyncTeleBot
+from typing import Optional
+from src import aio
+from src.localization import get_localized, get_language_code
+from src.message_handlers import get_base_markup
+from src.utils import get_dir_name, get_full_completed_text, get_file_hash
+from src.transcription import generate_transcription, FileRejectedError
+from src.summarization import EAGER_SUMMARY_PROMPTS
+from src.db.db import (
+    save_transcription,
+    find_transcription,
+    copy_transcription,
+    claim_job,
+    extend_job,
+    complete_job,
+    release_job,
+    fail_job,
+    delete_finished_jobs,
+)
+from src.db.models import Transcription, Job
+from src.media import extract_audio, MediaProcessingError, NoAudioStreamError
+from src.limits import (
+    get_int_env,
+    workers_count,
+    download_limit,
+    transcode_limit,
+    transcription_limit,
+)
+from src.downloads import (
+    download_file,
+    DownloadRejectedError,
+    check_file_size,
+    get_local_file_path,
+    link_local_file,
+    FileTooLargeError,
+)
+
+# Через сколько секунд задание упавшего воркера снова становится доступным
+JOB_VISIBILITY_TIMEOUT = get_int_env("JOB_VISIBILITY_TIMEOUT", 300)
+# Пауза перед повторной попыткой, умножается на номер попытки
+JOB_RETRY_DELAY = get_int_env("JOB_RETRY_DELAY", 30)
+# Как часто свободный воркер проверяет очередь, в секундах
+JOB_POLL_INTERVAL = get_int_env("JOB_POLL_INTERVAL", 1)
+# Сколько дней хранить выполненные и неудавшиеся задания, 0 - не удалять
+JOB_RETENTION_DAYS = get_int_env("JOB_RETENTION_DAYS", 7)
+# Как часто удалять старые задания, в секундах
+JOB_CLEANUP_INTERVAL = 3600
+
+# Ошибки в самом файле: повторная попытка закончится так же
+PERMANENT_ERRORS = (MediaProcessingError, DownloadRejectedError, FileRejectedError)
+
+# Как часто обновлять сообщение с прогрессом загрузки, в секундах
+PROGRESS_INTERVAL = 5
+
+# Переиспользовать транскрипции уже обработанных файлов
+TRANSCRIPTION_CACHE = bool(get_int_env("TRANSCRIPTION_CACHE", 1))
+
+# Отдавать ffmpeg ссылку на видео вместо того, чтобы сначала скачивать его целиком
+FFMPEG_STREAM_INPUT = bool(get_int_env("FFMPEG_STREAM_INPUT", 1))
+
+
+async def keep_job_locked(job_id: int) -> None:
+    # Продлеваем блокировку, пока задание обрабатывается, иначе его заберёт другой воркер
+    while True:
+        await asyncio.sleep(JOB_VISIBILITY_TIMEOUT / 3)
+        try:
+            await asyncio.to_thread(extend_job, job_id, JOB_VISIBILITY_TIMEOUT)
+        except Exception as e:
+            logging.error(e)
+
+
+async def process_job(bot: AsyncTeleBot, job: Job) -> None:
+    message = telebot.types.Message.de_json(job.message)
+    bot_message_id = job.bot_message_id
+    code = get_language_code(message)
+
+    if job.attempts > job.max_attempts:
+        # Воркер упал, обрабатывая задание в последний раз
+        await asyncio.to_thread(
+            fail_job, job, "visibility timeout expired", JOB_RETRY_DELAY
+        )
+        await bot.edit_message_text(
+            chat_id=message.chat.id,
+            message_id=bot_message_id,
+            text=get_localized("processing_error", code),
+        )
+        return
+
+    heartbeat = asyncio.create_task(keep_job_locked(job.id))
+
+    try:
+        await bot.edit_message_text(
+            chat_id=message.chat.id,
+            text=get_localized("start_processing", code),
+            message_id=bot_message_id,
+        )
+
+        await process_message(message, bot, bot_message_id)
+    except Exception as e:
+        logging.error("Ошибка обработки аудио")
+        logging.error(e)
+        retry = not isinstance(e, PERMANENT_ERRORS)
+        if await asyncio.to_thread(fail_job, job, str(e), JOB_RETRY_DELAY, retry):
+            logging.info(f"Job {job.id} will be retried")
+        else:
+            await bot.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=bot_message_id,
+                text=get_localized("processing_error", code),
+            )
+    else:
+        await asyncio.to_thread(complete_job, job.id)
+    finally:
+        heartbeat.cancel()
+
+
+async def delete_old_jobs_periodically() -> None:
+    while True:
+        try:
+            deleted = await asyncio.to_thread(
+                delete_finished_jobs, timedelta(days=JOB_RETENTION_DAYS)
+            )
+            if deleted:
+                logging.info(f"Deleted {deleted} finished jobs")
+        except Exception as e:
+            logging.error(e)
+
+        await asyncio.sleep(JOB_CLEANUP_INTERVAL)
+
+
+async def run_job(bot: AsyncTeleBot, job: Job, slots: asyncio.Semaphore) -> None:
+    try:
+        await process_job(bot, job)
+    except asyncio.CancelledError:
+        # Воркер останавливается - пусть задание сразу заберёт другой
+        await asyncio.to_thread(release_job, job.id)
+        logging.info(f"Job {job.id} has been returned to the queue")
+        raise
+    except Exception as e:
+        logging.error(e)
+    finally:
+        slots.release()
+
+
+async def acquire_slot(slots: asyncio.Semaphore, stop_event: asyncio.Event) -> bool:
+    """Ждёт свободный слот; возвращает False, если воркеры останавливаются."""
+    acquire = asyncio.ensure_future(slots.acquire())
+    stop = asyncio.ensure_future(stop_event.wait())
+    await asyncio.wait((acquire, stop), return_when=asyncio.FIRST_COMPLETED)
+    stop.cancel()
+
+    if not acquire.done():
+        acquire.cancel()
+        return False
+
+    if stop_event.is_set():
+        slots.release()
+        return False
+
+    return True
+
+
+async def run_workers(bot: AsyncTeleBot, stop_event: asyncio.Event) -> None:
+    """Забирает задания из очереди и обрабатывает до workers_count из них одновременно."""
+    logging.info(f"The queue workers have been started, {workers_count} slots")
+    slots = asyncio.Semaphore(workers_count)
+    tasks = set()
+    cleanup = None
+    if JOB_RETENTION_DAYS:
+        cleanup = asyncio.create_task(delete_old_jobs_periodically())
+
+    while not stop_event.is_set():
+        if not await acquire_slot(slots, stop_event):
+            break
+
+        try:
+            job = await asyncio.to_thread(claim_job, JOB_VISIBILITY_TIMEOUT)
+        except Exception as e:
+            logging.error(e)
+            job = None
+
+        if job is None:
+            slots.release()
+            try:
+                await asyncio.wait_for(stop_event.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        task = asyncio.create_task(run_job(bot, job, slots))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if cleanup is not None:
+        cleanup.cancel()
+
+    # Задание может выполняться час, дождаться его docker не даст
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await bot.close_session()
+    logging.info("The queue workers have been stopped")
+
+
+def start_workers(bot: AsyncTeleBot) -> tuple[Future, asyncio.Event]:
+    stop_event = asyncio.Event()
+    return aio.submit(run_workers(bot, stop_event)), stop_event
+
+
+def stop_workers(workers: tuple[Future, asyncio.Event]) -> None:
+    future, stop_event = workers
+    aio.call_soon(stop_event.set)
+    future.result()
+
+
+async def get_file_path(bot: AsyncTeleBot, file_id: str) -> str:
+    for i in range(3):
+        try:
+            return (await bot.get_file(file_id)).file_path
+        except Exception as e:
+            logging.error(e)
+            if i < 2:
+                continue
+            raise e
+
+
+def get_progress_reporter(
+    message: telebot.types.Message, bot: AsyncTeleBot, bot_message_id: int
+):
+    code = get_language_code(message)
+    last_report = {"time": time.monotonic(), "percent": None}
+
+    async def report(downloaded: int, total: Optional[int]) -> None:
+        if not total:
+            return
+
+        now = time.monotonic()
+        percent = downloaded * 100 // total
+        if (
+            now - last_report["time"] < PROGRESS_INTERVAL
+            or percent == last_report["percent"]
+        ):
+            return
+
+        last_report["time"] = now
+        last_report["percent"] = percent
+        try:
+            await bot.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=bot_message_id,
+                text=get_localized("downloading_file", code).format(percent=percent),
+            )
+        except Exception as e:
+            logging.error(e)
+
+    return report
+
+
+async def process_message(
+    message: telebot.types.Message, bot: AsyncTeleBot, bot_message_id: int
+) -> None:
+    code = get_language_code(message)
+    dir_name = get_dir_name(message.chat.id, bot_message_id)
+    file_name = ""
+    try:
+        file_api = os.getenv("TG_FILES_API_ADDRESS")
+        tg_api = os.getenv("TG_API_KEY")
+        file_url = f"{file_api}/file/bot{tg_api}"
+
+        # Папка могла остаться от предыдущей попытки, прерванной перезапуском
+        await asyncio.to_thread(shutil.rmtree, dir_name, ignore_errors=True)
+        os.mkdir(dir_name)
+
+        attachment = None
+        need_extract_audio = False
+        if message.audio:
+            attachment = message.audio
+            file_name = f"{dir_name}/{message.audio.file_name}"
+
+        elif message.voice:
+            attachment = message.voice
+            file_name = f"{dir_name}/voice.ogg"
+
+        elif message.video or message.document:
+            attachment = message.video or message.document
+            file_name = f"{dir_name}/{attachment.file_name}"
+            need_extract_audio = True
+
+        else:
+            await bot.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=bot_message_id,
+                text=get_localized("unknown_content_type", code),
+            )
+            return
+
+        if TRANSCRIPTION_CACHE and (
+            cached := await asyncio.to_thread(
+                find_transcription, file_unique_id=attachment.file_unique_id
+            )
+        ):
+            await reuse_transcription(cached, message, bot, bot_message_id)
+            logging.info("Done, reused the transcription of the same file")
+            return
+
+        check_file_size(attachment.file_size)
+        file_server_path = await get_file_path(bot, attachment.file_id)
+        file_full_server_path = f"{file_url}{file_server_path}"
+
+        local_file_path = get_local_file_path(file_server_path)
+        audio_file_name = None
+
+        if local_file_path:
+            link_local_file(local_file_path, file_name)
+
+        elif need_extract_audio and FFMPEG_STREAM_INPUT:
+            # ffmpeg читает видео прямо с файлового сервера, на диск пишется только звук
+            try:
+                async with download_limit, transcode_limit:
+                    audio_file_name = await extract_audio(
+                        file_full_server_path, f"{dir_name}/audio"
+                    )
+            except MediaProcessingError as e:
+                logging.warning(f"Streaming audio extraction failed, downloading: {e}")
+
+        if not local_file_path and audio_file_name is None:
+            async with download_limit:
+                await download_file(
+                    file_full_server_path,
+                    file_name,
+                    on_progress=get_progress_reporter(message, bot, bot_message_id),
+                )
+
+        if audio_file_name is not None:
+            file_name = audio_file_name
+
+        elif need_extract_audio:
+            video_file_name = file_name
+
+            async with transcode_limit:
+                file_name = await extract_audio(video_file_name, f"{dir_name}/audio")
+
+            if file_name != video_file_name:
+                os.remove(video_file_name)
+
+        await process_audio(
+            file_name, message, bot, bot_message_id, attachment.file_unique_id
+        )
+
+        logging.info("Done")
+    except FileTooLargeError as e:
+        logging.error(e)
+        await bot.edit_message_text(
+            chat_id=message.chat.id,
+            message_id=bot_message_id,
+            text=get_localized("file_too_large", code),
+        )
+    except NoAudioStreamError as e:
+        # Повторять бесполезно
+        logging.error(e)
+        await bot.edit_message_text(
+            chat_id=message.chat.id,
+            message_id=bot_message_id,
+            text=get_localized("processing_error", code),
+        )
+    finally:
+        try:
+            await asyncio.to_thread(shutil.rmtree, dir_name)
+        except:
+            logging.error(f'Error removing "{dir_name}"')
+
+
+async def send_completed(
+    message: telebot.types.Message, bot: AsyncTeleBot, bot_message_id: int
+) -> None:
+    code = get_language_code(message)
+    await bot.edit_message_text(
+        chat_id=message.chat.id,
+        message_id=bot_message_id,
+        text=get_full_completed_text(code),
+        reply_markup=get_base_markup(code),
+    )
+
+
+async def reuse_transcription(
+    transcription: Transcription,
+    message: telebot.types.Message,
+    bot: AsyncTeleBot,
+    bot_message_id: int,
+) -> None:
+    await asyncio.to_thread(
+        copy_transcription,
+        transcription,
+        message.from_user.id,
+        message.chat.id,
+        bot_message_id,
+    )
+    await send_completed(message, bot, bot_message_id)
+
+
+async def process_audio(
+    audio_file_name: str,
+    message: telebot.types.Message,
+    bot: AsyncTeleBot,
+    bot_message_id: int,
+    file_unique_id: Optional[str] = None,
+):
+    audio_hash = None
+    if TRANSCRIPTION_CACHE:
+        audio_hash = await asyncio.to_thread(get_file_hash, audio_file_name)
+        if cached := await asyncio.to_thread(find_transcription, audio_hash=audio_hash):
+            await reuse_transcription(cached, message, bot, bot_message_id)
+            logging.info("Reused the transcription of the same audio")
+            return
+
+    async with transcription_limit:
+        transcription = await generate_transcription(audio_file_name)
+    await asyncio.to_thread(
+        save_transcription,
+        transcription,
+        message.from_user.id,
+        message.chat.id,
+        bot_message_id,
+        file_unique_id=file_unique_id,
+        audio_hash=audio_hash,
+        # Саммари готовит процесс, который отвечает пользователям
+        precompute=bool(EAGER_SUMMARY_PROMPTS),
+    )
+
+    await send_completed(message, bot, bot_message_id)
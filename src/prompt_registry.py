@@ -0,0 +1,109 @@
+import threading
+import logging
+import select
+import time
+
+from typing import Optional
+from src.limits import get_int_env
+from src.db.db import engine, get_active_prompts
+from src.db.models import Prompt
+
+# Как часто перечитывать промпты из базы, в секундах; 0 - только по уведомлению
+PROMPT_CACHE_TTL = get_int_env("PROMPT_CACHE_TTL", 300)
+# Сбрасывать кэш сразу, когда таблица prompts меняется (LISTEN/NOTIFY)
+PROMPT_CACHE_LISTEN = bool(get_int_env("PROMPT_CACHE_LISTEN", 1))
+
+# Канал, в который триггер на таблице prompts отправляет уведомления
+CHANNEL = "prompts_changed"
+RECONNECT_DELAY = 5
+
+prompts_by_name: dict[str, Prompt] = {}
+prompts_by_id: dict[int, Prompt] = {}
+loaded_at: Optional[float] = None
+load_lock = threading.Lock()
+
+
+def load_prompts() -> None:
+    global prompts_by_name, prompts_by_id, loaded_at
+
+    prompts = get_active_prompts()
+    by_name = {}
+    for prompt in prompts:
+        # При одинаковых именах берётся самый ранний промпт
+        by_name.setdefault(prompt.name, prompt)
+
+    # Словари заменяются целиком, поэтому читать их можно без блокировки
+    prompts_by_name = by_name
+    prompts_by_id = {prompt.id: prompt for prompt in prompts}
+    loaded_at = time.monotonic()
+
+
+def is_stale() -> bool:
+    if loaded_at is None:
+        return True
+
+    return bool(PROMPT_CACHE_TTL) and time.monotonic() - loaded_at >= PROMPT_CACHE_TTL
+
+
+def ensure_loaded() -> None:
+    if not is_stale():
+        return
+
+    with load_lock:
+        if is_stale():
+            load_prompts()
+
+
+def invalidate() -> None:
+    global loaded_at
+    loaded_at = None
+
+
+def get_prompt_by_name(name: str) -> Optional[Prompt]:
+    """Возвращает не удалённый промпт по имени из кэша."""
+    ensure_loaded()
+    return prompts_by_name.get(name)
+
+
+def get_prompt(prompt_id: int) -> Optional[Prompt]:
+    ensure_loaded()
+    return prompts_by_id.get(prompt_id)
+
+
+def listen_for_changes() -> None:
+    while True:
+        try:
+            # Отдельное соединение, чтобы не занимать место в пуле навсегда
+            connection = engine.raw_connection()
+            connection.detach()
+            try:
+                driver_connection = connection.driver_connection
+                driver_connection.autocommit = True
+                driver_connection.cursor().execute(f"LISTEN {CHANNEL}")
+
+                # Пока соединения не было, уведомления могли потеряться
+                invalidate()
+                while True:
+                    if select.select([driver_connection], [], [], 60) == ([], [], []):
+                        continue
+
+                    driver_connection.poll()
+                    if driver_connection.notifies:
+                        driver_connection.notifies.clear()
+                        invalidate()
+                        logging.info("Prompts have changed, the cache is invalidated")
+            finally:
+                connection.close()
+        except Exception as e:
+            logging.error(f"Prompt change listener failed: {e}")
+            time.sleep(RECONNECT_DELAY)
+
+
+def start_prompt_registry() -> None:
+    """Загружает промпты и подписывается на изменения таблицы prompts."""
+    ensure_loaded()
+
+    if PROMPT_CACHE_LISTEN:
+        threading.Thread(
+            target=listen_for_changes, name="prompt-listener", daemon=True
+        ).start()
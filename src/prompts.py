@@ -4,6 +4,9 @@ summary_prompt = f"""Ты - интеллектуальный аналитик д
 short_summary_prompt = f"""{summary_prompt}
 Только давай покороче"""
 
+# Применяется к готовому саммари, а не ко всей транскрипции
+derived_short_summary_prompt = """Ты получаешь саммари встречи, разбитое на логические блоки с заголовками. Сократи его: оставь только самые важные пункты каждого блока, а второстепенные блоки объедини или опусти. Сохрани заголовки с эмоджи, даты, имена и названия. Не используй номера участников, например, Участник_00, либо Speaker_00."""
+
 protocol_prompt = f"""Проанализируй предоставленный текст совещания или статусной встречи и создай по нему структурированное саммари.
 
 Инструкция по анализу:
@@ -22,3 +25,7 @@ protocol_prompt = f"""Проанализируй предоставленный
 -   [План]: [Что запланировано]. – [Ответственный] ([Срок, если есть]).
 -   [Требование/Необходимо]: [Что требуется]. – [Ответственный].
 -   [Вопрос на уточнение]: [Суть вопроса]. – [Кому адресован]."""
+
+chunk_summary_prompt = """Ты получаешь фрагмент {number} из {total} длинной расшифровки встречи, полученной после распознавания речи. Перескажи этот фрагмент подробно, но сжато: сохрани обсуждаемые темы, факты, решения, договорённости, задачи, имена, даты и сроки. Особенно сохрани всё, что понадобится для следующей задачи:
+{task}
+Не добавляй вступлений и общих выводов - твой пересказ будет объединён с пересказами остальных фрагментов."""
@@ -0,0 +1,395 @@
+import aiohttp
+import asyncio
+import logging
+import math
+import re
+import os
+
+from typing import Awaitable, Callable, Optional
+from src.limits import (
+    get_int_env,
+    priority,
+    Priority,
+    BACKGROUND,
+    llm_limit,
+    llm_interactive_slots,
+)
+from src.prompts import chunk_summary_prompt
+from src.utils import generate_summary, md_to_text, LLM_MODEL
+from sqlalchemy import inspect
+from src.db.db import (
+    get_summary,
+    save_summary,
+    get_transcription_text,
+    claim_precompute,
+)
+from src.prompt_registry import get_prompt, get_prompt_by_name
+from src.db.models import Transcription, Prompt
+from src import http_client, aio
+from src.http_client import LLM
+
+# Размер контекста модели в токенах, 0 - узнать у сервера
+LLM_CONTEXT_TOKENS = get_int_env("LLM_CONTEXT_TOKENS", 0)
+DEFAULT_CONTEXT_TOKENS = 8192
+# Сколько токенов контекста оставить под ответ модели
+LLM_MAX_OUTPUT_TOKENS = get_int_env("LLM_MAX_OUTPUT_TOKENS", 2048)
+# Среднее число символов в токене; для русского текста около трёх
+CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN") or 3)
+# Запас на служебные токены шаблона чата
+PROMPT_OVERHEAD_TOKENS = 100
+# Сколько раз можно сворачивать пересказы, прежде чем отправить как есть
+MAX_REDUCE_LEVELS = 3
+
+# Какие саммари готовить заранее, сразу после транскрипции, например
+# "summary,short_summary,protocol"; пусто - только по запросу пользователя
+EAGER_SUMMARY_PROMPTS = [
+    name.strip()
+    for name in (os.getenv("EAGER_SUMMARY_PROMPTS") or "").split(",")
+    if name.strip()
+]
+# Как часто проверять, не появились ли новые транскрипции, в секундах
+PRECOMPUTE_POLL_INTERVAL = 5
+
+# Строка реплики из generate_transcription: "Участник_00: текст"
+TURN_START = re.compile(r"^[^:\n]{1,40}: ")
+
+context_tokens: Optional[int] = None
+context_tokens_lock = asyncio.Lock()
+# Саммари, которые генерируются сейчас; их ждут все, кому они нужны
+summary_tasks: dict[tuple[int, int], "SharedSummary"] = {}
+
+
+class SummarizationError(Exception):
+    pass
+
+
+class SharedSummary:
+    """Генерация саммари, которую ждут один или несколько запросов.
+
+    Генерация идёт с приоритетом самого срочного из ждущих, а частичный
+    результат получают все, кто передал on_partial.
+    """
+
+    def __init__(self, task_priority: Priority):
+        self.priority = task_priority
+        self.listeners: list[Callable[[str], Awaitable]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    async def on_partial(self, content: str) -> None:
+        for listener in list(self.listeners):
+            try:
+                await listener(content)
+            except Exception as e:
+                logging.warning(f"Unable to pass partial summary: {e}")
+
+    async def run(self, generation: Awaitable[str]) -> str:
+        priority.set(self.priority)
+        return await generation
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+async def fetch_json(path: str) -> dict:
+    async with http_client.request(
+        LLM, "GET", f"{os.getenv('LLM_URL')}{path}"
+    ) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+async def fetch_context_tokens() -> Optional[int]:
+    """Спрашивает размер контекста у сервера LLM.
+
+    llama.cpp отдаёт рабочий n_ctx слота в /props, vLLM - max_model_len
+    в /v1/models.
+    """
+    try:
+        props = await fetch_json("/props")
+        settings = props.get("default_generation_settings") or {}
+        size = settings.get("n_ctx") or props.get("n_ctx")
+        if size:
+            return int(size)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.debug(f"No llama.cpp /props: {e}")
+
+    try:
+        models = (await fetch_json("/v1/models")).get("data") or []
+        model = next(
+            (model for model in models if model.get("id") == LLM_MODEL),
+            models[0] if models else {},
+        )
+        if model.get("max_model_len"):
+            return int(model["max_model_len"])
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.warning(f"Unable to get LLM context size: {e}")
+
+    return None
+
+
+async def get_context_tokens() -> int:
+    """Берёт размер контекста из настроек или у сервера LLM."""
+    global context_tokens
+
+    if LLM_CONTEXT_TOKENS:
+        return LLM_CONTEXT_TOKENS
+
+    async with context_tokens_lock:
+        if context_tokens is not None:
+            return context_tokens
+
+        context_tokens = await fetch_context_tokens()
+        if context_tokens is None:
+            context_tokens = DEFAULT_CONTEXT_TOKENS
+            logging.warning(
+                f"LLM server did not report its context size, assuming "
+                f"{context_tokens} tokens; set LLM_CONTEXT_TOKENS explicitly"
+            )
+
+        logging.info(f"LLM context size is {context_tokens} tokens")
+        return context_tokens
+
+
+async def get_input_budget(system_prompt: str) -> int:
+    budget = (
+        await get_context_tokens()
+        - LLM_MAX_OUTPUT_TOKENS
+        - estimate_tokens(system_prompt)
+        - PROMPT_OVERHEAD_TOKENS
+    )
+    if budget <= 0:
+        raise SummarizationError(
+            "The prompt does not fit into the LLM context, check LLM_CONTEXT_TOKENS"
+        )
+
+    return budget
+
+
+def split_turns(text: str) -> list[str]:
+    """Делит транскрипцию на реплики участников вместе со строками-продолжениями."""
+    turns = []
+    for line in text.splitlines():
+        if turns and not TURN_START.match(line):
+            turns[-1] += f"\n{line}"
+        else:
+            turns.append(line)
+
+    return turns
+
+
+def split_into_chunks(text: str, max_tokens: int) -> list[str]:
+    """Собирает реплики в куски не длиннее max_tokens.
+
+    Реплики не разрезаются, кроме тех, что сами не помещаются в кусок.
+    """
+    max_chars = max(1, int(max_tokens * CHARS_PER_TOKEN))
+
+    pieces = []
+    for turn in split_turns(text):
+        while len(turn) > max_chars:
+            cut = turn.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(turn[:cut])
+            turn = turn[cut:].lstrip()
+        pieces.append(turn)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+async def summarize_chunks(text: str, system_prompt: str) -> str:
+    """Пересказывает куски текста параллельно и склеивает пересказы по порядку."""
+    chunk_prompt = chunk_summary_prompt.format(number=0, total=0, task=system_prompt)
+    chunks = split_into_chunks(text, await get_input_budget(chunk_prompt))
+    logging.info(f"Summarizing {len(chunks)} chunks of a long text")
+
+    # Одновременность ограничивается внутри generate_summary; при ошибке
+    # остальные куски отменяются, чтобы не занимать LLM впустую
+    summaries = await aio.gather(
+        *(
+            generate_summary(
+                chunk,
+                chunk_summary_prompt.format(
+                    number=i + 1, total=len(chunks), task=system_prompt
+                ),
+            )
+            for i, chunk in enumerate(chunks)
+        )
+    )
+
+    return "\n\n".join(summary.strip() for summary in summaries)
+
+
+async def summarize(
+    text: str,
+    system_prompt: str,
+    on_partial: Optional[Callable[[str], Awaitable]] = None,
+) -> str:
+    """Выполняет запрос к LLM, при необходимости сворачивая текст по частям.
+
+    Если текст не помещается в контекст модели, он режется по репликам,
+    куски пересказываются параллельно, а итоговый запрос с system_prompt
+    выполняется уже по объединённым пересказам.
+    """
+    budget = await get_input_budget(system_prompt)
+
+    level = 0
+    while estimate_tokens(text) > budget and level < MAX_REDUCE_LEVELS:
+        text = await summarize_chunks(text, system_prompt)
+        level += 1
+
+    return await generate_summary(text, system_prompt, on_partial=on_partial)
+
+
+async def get_text(transcription: Transcription) -> str:
+    if "text" not in inspect(transcription).unloaded:
+        return transcription.text
+
+    text = await asyncio.to_thread(get_transcription_text, transcription.id)
+    if text is None:
+        raise SummarizationError("The transcription has been deleted")
+
+    return text
+
+
+async def generate_prompt_summary(
+    transcription: Transcription,
+    prompt: Prompt,
+    on_partial: Optional[Callable[[str], Awaitable]],
+    path: frozenset[int],
+) -> str:
+    text = None
+    if prompt.source_prompt_id is not None:
+        if prompt.source_prompt_id in path:
+            raise SummarizationError(f'Prompt "{prompt.name}" has a dependency cycle')
+
+        source = await asyncio.to_thread(get_prompt, prompt.source_prompt_id)
+        if source is not None:
+            text = await get_prompt_summary(transcription, source, path=path)
+
+    # Текст транскрипции загружается, только если промпт работает не с другим саммари
+    if text is None:
+        text = await get_text(transcription)
+
+    content = md_to_text(await summarize(text, prompt.text, on_partial=on_partial))
+
+    # Если саммари уже сохранил другой процесс, отдаём его текст
+    return await asyncio.to_thread(save_summary, content, transcription.id, prompt.id)
+
+
+async def get_prompt_summary(
+    transcription: Transcription,
+    prompt: Prompt,
+    on_partial: Optional[Callable[[str], Awaitable]] = None,
+    path: frozenset[int] = frozenset(),
+) -> str:
+    """Возвращает саммари транскрипции по промпту, генерируя его при необходимости.
+
+    Если у промпта есть source_prompt_id, на вход LLM идёт не транскрипция,
+    а саммари по исходному промпту - из базы или сгенерированное так же.
+    Одно и то же саммари одновременно генерируется только один раз.
+    """
+    key = (transcription.id, prompt.id)
+    shared = summary_tasks.get(key)
+    if shared is None:
+        summary = await asyncio.to_thread(get_summary, transcription.id, prompt.id)
+        if summary is not None:
+            return summary.text
+
+        shared = summary_tasks.get(key)
+
+    caller_priority = priority.get()
+    if shared is None:
+        shared = SharedSummary(Priority(caller_priority.value))
+        shared.task = asyncio.create_task(
+            shared.run(
+                generate_prompt_summary(
+                    transcription, prompt, shared.on_partial, path | {prompt.id}
+                )
+            )
+        )
+        summary_tasks[key] = shared
+        shared.task.add_done_callback(lambda _: summary_tasks.pop(key, None))
+
+    caller_priority.add_dependency(shared.priority)
+    if on_partial is not None:
+        shared.listeners.append(on_partial)
+
+    try:
+        # Отмена одного из ждущих не должна прерывать генерацию для остальных
+        return await asyncio.shield(shared.task)
+    finally:
+        if on_partial is not None:
+            shared.listeners.remove(on_partial)
+
+
+async def precompute_summaries(transcription: Transcription) -> None:
+    # Фоновые запросы уступают LLM интерактивным, см. PriorityLimit
+    priority.set(Priority(BACKGROUND))
+
+    async def precompute(name: str) -> None:
+        try:
+            prompt = await asyncio.to_thread(get_prompt_by_name, name)
+            if prompt is None:
+                logging.warning(f'Unknown prompt "{name}" in EAGER_SUMMARY_PROMPTS')
+                return
+
+            await get_prompt_summary(transcription, prompt)
+        except Exception as e:
+            logging.error(f'Unable to precompute "{name}": {e}')
+
+    # Независимые саммари готовятся параллельно, общие зависимости - один раз
+    await asyncio.gather(*(precompute(name) for name in EAGER_SUMMARY_PROMPTS))
+
+
+async def precompute_pending_summaries() -> None:
+    while True:
+        try:
+            transcription = await asyncio.to_thread(claim_precompute)
+        except Exception as e:
+            logging.error(e)
+            transcription = None
+
+        if transcription is None:
+            await asyncio.sleep(PRECOMPUTE_POLL_INTERVAL)
+            continue
+
+        await precompute_summaries(transcription)
+
+
+def start_precomputing() -> None:
+    """Готовит в фоне саммари из EAGER_SUMMARY_PROMPTS для новых транскрипций.
+
+    Транскрипции для этого помечают воркеры, а саммари готовит процесс,
+    который отвечает пользователям: только там PriorityLimit видит интерактивные
+    запросы и может пропускать их вперёд.
+    """
+    if not EAGER_SUMMARY_PROMPTS:
+        return
+
+    if llm_limit.reserved < llm_interactive_slots:
+        logging.warning(
+            f"LLM_INTERACTIVE_SLOTS={llm_interactive_slots} does not fit into "
+            f"LLM_CONCURRENCY={llm_limit.value}, only {llm_limit.reserved} "
+            f"slots are reserved for users"
+        )
+    if not llm_limit.reserved and llm_interactive_slots:
+        logging.warning(
+            "No LLM slot can be reserved for users, precomputing is disabled; "
+            "raise LLM_CONCURRENCY to enable EAGER_SUMMARY_PROMPTS"
+        )
+        return
+
+    aio.submit(precompute_pending_summaries())
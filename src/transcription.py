@@ -0,0 +1,420 @@
+import threading
+import aiohttp
+import asyncio
+import logging
+import json
+import math
+import time
+import os
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from typing import Iterator, Optional
+from src.localization import get_localized
+from src.limits import get_int_env, transcode_limit
+from src.media import get_duration, detect_silences, downmix_audio
+from src import http_client, aio
+from src.http_client import WHISPERX, CONNECT_TIMEOUT
+from src.backends import (
+    Backend,
+    backends,
+    pick_backend,
+    use_backend,
+    mark_failed,
+    mark_healthy,
+)
+
+# Интервалы опроса WhisperX, в секундах
+POLL_MIN_INTERVAL = float(os.getenv("WHISPERX_POLL_MIN_INTERVAL") or 0.5)
+POLL_MAX_INTERVAL = float(os.getenv("WHISPERX_POLL_MAX_INTERVAL") or 30)
+POLL_BACKOFF = 1.5
+POLL_MAX_INITIAL_WAIT = 300
+
+# Сколько секунд обработки занимает одна секунда записи
+REALTIME_FACTOR = float(os.getenv("WHISPERX_REALTIME_FACTOR") or 0.1)
+
+# Сколько секунд сервер может держать запрос результата, 0 - обычный опрос
+LONG_POLL_TIMEOUT = get_int_env("WHISPERX_LONG_POLL", 0)
+
+# Адрес, на который WhisperX сообщает о готовности результата
+CALLBACK_URL = os.getenv("WHISPERX_CALLBACK_URL")
+CALLBACK_PORT = get_int_env("WHISPERX_CALLBACK_PORT", 0)
+
+# Длинные записи режутся по паузам на куски примерно такой длины, 0 - не резать
+CHUNK_SECONDS = get_int_env("TRANSCRIPTION_CHUNK_SECONDS", 0)
+# Сколько кусков распознаётся одновременно, 0 - по числу серверов WhisperX
+CHUNK_PARALLELISM = get_int_env("TRANSCRIPTION_CHUNK_PARALLELISM", 0)
+# Минимальное косинусное сходство голосов, чтобы считать их одним участником
+SPEAKER_SIMILARITY = float(os.getenv("SPEAKER_SIMILARITY") or 0.7)
+
+result_events: dict[str, asyncio.Event] = {}
+result_events_lock = threading.Lock()
+
+
+class TranscriptionError(Exception):
+    pass
+
+
+class BackendError(Exception):
+    pass
+
+
+class FileRejectedError(TranscriptionError):
+    """WhisperX ответил 4xx на сам файл - другие серверы ответят так же."""
+
+
+class CallbackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        job_id = parse_qs(urlparse(self.path).query).get("id", [None])[0]
+        if job_id is None:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job_id = json.loads(self.rfile.read(length)).get("id")
+            except Exception as e:
+                logging.error(e)
+
+        if job_id is None:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        notify_result(str(job_id))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_callback_server() -> Optional[ThreadingHTTPServer]:
+    if not CALLBACK_PORT:
+        return None
+
+    server = ThreadingHTTPServer(("0.0.0.0", CALLBACK_PORT), CallbackHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"WhisperX callback server is listening on port {CALLBACK_PORT}")
+
+    return server
+
+
+def notify_result(job_id: str) -> None:
+    with result_events_lock:
+        event = result_events.get(job_id)
+
+    # Вызывается из потока HTTP-сервера, а событие принадлежит общему циклу
+    if event is not None:
+        aio.call_soon(event.set)
+
+
+def get_poll_delays(duration: Optional[float]) -> Iterator[float]:
+    """Сначала ждём примерное время обработки, затем опрашиваем всё реже."""
+    if duration:
+        expected = duration * REALTIME_FACTOR
+        if expected > POLL_MAX_INTERVAL:
+            yield min(expected * 0.8, POLL_MAX_INITIAL_WAIT)
+
+    delay = POLL_MIN_INTERVAL
+    while True:
+        yield delay
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+
+async def get_result(backend: Backend, job_id: str) -> dict:
+    params = {"id": job_id}
+    read_timeout = 30
+    if LONG_POLL_TIMEOUT:
+        params["wait"] = LONG_POLL_TIMEOUT
+        read_timeout += LONG_POLL_TIMEOUT
+
+    async with http_client.request(
+        WHISPERX,
+        "GET",
+        f"{backend.url}/api/result",
+        params=params,
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=CONNECT_TIMEOUT, sock_read=read_timeout
+        ),
+    ) as response:
+        response.raise_for_status()
+        return await response.json(content_type=None)
+
+
+async def wait_for_result(
+    backend: Backend, job_id: str, duration: Optional[float]
+) -> dict:
+    event = asyncio.Event()
+    with result_events_lock:
+        result_events[job_id] = event
+
+    try:
+        delays = get_poll_delays(duration)
+        while True:
+            started = time.monotonic()
+            response_data = await get_result(backend, job_id)
+
+            status = response_data["status"]
+            if status == "error":
+                raise TranscriptionError(response_data)
+
+            if status == "done":
+                return response_data["data"]
+
+            # Сервер держал запрос - значит, он поддерживает долгий опрос
+            if LONG_POLL_TIMEOUT and time.monotonic() - started >= LONG_POLL_TIMEOUT / 2:
+                continue
+
+            try:
+                await asyncio.wait_for(event.wait(), next(delays))
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        with result_events_lock:
+            result_events.pop(job_id, None)
+
+
+async def submit(backend: Backend, audio_file: str, options: dict = {}) -> str:
+    fields = dict(options)
+    if CALLBACK_URL:
+        fields["callback_url"] = CALLBACK_URL
+
+    with open(audio_file, "rb") as file:
+        data = aiohttp.FormData(fields)
+        data.add_field("file", file, filename=os.path.basename(audio_file))
+
+        # Повтор после обрыва создал бы второе задание, на это есть переключение сервера
+        async with http_client.request(
+            WHISPERX,
+            "POST",
+            f"{backend.url}/api/transcription",
+            retries=0,
+            data=data,
+        ) as response:
+            # Ответ 4xx на отправку относится к самому файлу
+            if 400 <= response.status < 500:
+                raise FileRejectedError(
+                    f"WhisperX backend {backend.url} rejected the file: "
+                    f"{response.status} {response.reason}"
+                )
+            response.raise_for_status()
+            response_data = await response.json(content_type=None)
+
+    return str(response_data["id"])
+
+
+async def run_transcription(
+    audio_file: str, duration: Optional[float], options: dict = {}
+) -> dict:
+    """Отправляет файл на наименее загруженный сервер WhisperX.
+
+    Если сервер недоступен, перестал отвечать или вернул ошибку во время
+    обработки, задание переотправляется на следующий. Ответ 4xx на отправку
+    относится к самому файлу, поэтому другие серверы не пробуются.
+    """
+    tried = []
+    while True:
+        backend = pick_backend(exclude=tried)
+        if backend is None:
+            raise BackendError("No WhisperX backends available")
+        tried.append(backend)
+
+        with use_backend(backend):
+            try:
+                job_id = await submit(backend, audio_file, options)
+                result = await wait_for_result(backend, job_id, duration)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error(f"WhisperX backend {backend.url} failed: {e}")
+                mark_failed(backend)
+                continue
+
+        mark_healthy(backend)
+        return result
+
+
+def get_split_points(
+    duration: float, silences: list[tuple[float, float]], chunk_seconds: float
+) -> list[float]:
+    """Выбирает места разреза: ближайшую к границе куска паузу или саму границу."""
+    window = chunk_seconds / 4
+    points = []
+    position = 0.0
+    while duration - position > chunk_seconds + window:
+        target = position + chunk_seconds
+        candidates = [
+            (start + end) / 2
+            for start, end in silences
+            if abs((start + end) / 2 - target) <= window
+        ]
+        point = min(candidates, key=lambda x: abs(x - target), default=target)
+        points.append(point)
+        position = point
+
+    return points
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    if not norm:
+        return 0.0
+
+    return dot / norm
+
+
+def match_speakers(
+    known: dict[str, list[float]], embeddings: dict[str, list[float]]
+) -> dict[str, str]:
+    """Сопоставляет участников куска с уже известными по эмбеддингам голоса.
+
+    Новые участники получают следующий свободный номер и добавляются в known.
+    """
+    pairs = sorted(
+        (
+            (cosine_similarity(embedding, known_embedding), label, known_label)
+            for label, embedding in embeddings.items()
+            for known_label, known_embedding in known.items()
+        ),
+        reverse=True,
+    )
+
+    mapping = {}
+    used = set()
+    for similarity, label, known_label in pairs:
+        if similarity < SPEAKER_SIMILARITY:
+            break
+        if label in mapping or known_label in used:
+            continue
+        mapping[label] = known_label
+        used.add(known_label)
+
+    for label in sorted(embeddings):
+        if label not in mapping:
+            new_label = f"SPEAKER_{len(known):02d}"
+            known[new_label] = embeddings[label]
+            mapping[label] = new_label
+
+    return mapping
+
+
+def get_chunk_speaker(label: str, chunk_number: int) -> str:
+    # Без эмбеддингов одинаковые номера в разных кусках - обычно разные люди
+    return f"SPEAKER_c{chunk_number}_{label.removeprefix('SPEAKER_')}"
+
+
+def merge_chunks(results: list[dict], offsets: list[float]) -> dict:
+    """Склеивает результаты кусков, сдвигая время и сводя номера участников.
+
+    Участники кусков, для которых WhisperX не вернул эмбеддинги голоса,
+    получают номера с номером куска, например SPEAKER_c2_00.
+    """
+    segments = []
+    known_speakers = {}
+    warned = False
+
+    for chunk_number, (result, offset) in enumerate(zip(results, offsets), 1):
+        embeddings = result.get("speaker_embeddings")
+        mapping = {}
+        if embeddings:
+            mapping = match_speakers(known_speakers, embeddings)
+        elif not warned:
+            logging.warning(
+                "WhisperX returned no speaker embeddings, speakers are numbered per chunk"
+            )
+            warned = True
+
+        for segment in result["segments"]:
+            if isinstance(segment, dict):
+                segment = dict(segment)
+                for key in ("start", "end"):
+                    if key in segment:
+                        segment[key] += offset
+                if "speaker" in segment:
+                    segment["speaker"] = mapping.get(segment["speaker"]) or (
+                        get_chunk_speaker(segment["speaker"], chunk_number)
+                    )
+            segments.append(segment)
+
+    return {"language": results[0]["language"], "segments": segments}
+
+
+async def run_chunked_transcription(
+    audio_file: str, duration: float, split_points: list[float]
+) -> dict:
+    bounds = list(zip([0.0] + split_points, split_points + [duration]))
+    base_name = os.path.splitext(audio_file)[0]
+    chunk_files = [f"{base_name}_chunk{i}.flac" for i in range(len(bounds))]
+    parallelism = CHUNK_PARALLELISM or max(1, len(backends))
+    logging.info(f"Transcribing {len(bounds)} chunks with parallelism {parallelism}")
+
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def transcribe_chunk(i: int) -> dict:
+        start, end = bounds[i]
+        async with semaphore:
+            async with transcode_limit:
+                await downmix_audio(audio_file, chunk_files[i], start=start, end=end)
+            return await run_transcription(
+                chunk_files[i], end - start, {"return_speaker_embeddings": "true"}
+            )
+
+    try:
+        # Если один кусок не распознался, остальные бесполезны - задание повторят
+        results = await aio.gather(*(transcribe_chunk(i) for i in range(len(bounds))))
+    finally:
+        for chunk_file in chunk_files:
+            if os.path.exists(chunk_file):
+                os.remove(chunk_file)
+
+    return merge_chunks(results, [start for start, _ in bounds])
+
+
+async def generate_transcription(audio_file):
+    duration = None
+    try:
+        duration = await get_duration(audio_file)
+    except Exception as e:
+        logging.warning(f"Unable to get audio duration: {e}")
+
+    split_points = []
+    # Запись короче этого get_split_points всё равно не режет, и декодировать
+    # её целиком в поисках пауз незачем
+    if CHUNK_SECONDS and duration and duration > CHUNK_SECONDS * 1.25:
+        async with transcode_limit:
+            silences = await detect_silences(audio_file)
+        split_points = get_split_points(duration, silences, CHUNK_SECONDS)
+
+    started = time.monotonic()
+    if split_points:
+        responseData = await run_chunked_transcription(
+            audio_file, duration, split_points
+        )
+    else:
+        responseData = await run_transcription(audio_file, duration)
+    logging.info(
+        f"Transcription of {duration or 0:.0f}s of audio took {time.monotonic() - started:.1f}s"
+    )
+
+    language_code = responseData["language"]
+
+    listToReturn = []
+
+    prev_speaker = None
+
+    for i in responseData["segments"]:
+        speaker = None
+        if isinstance(i, dict) and "speaker" in i:
+            speaker = i["speaker"]
+        else:
+            speaker = get_localized("unknown_speaker", language_code)
+
+        if prev_speaker != speaker:
+            listToReturn.append(f'{speaker}: {i["text"].strip()}')
+            prev_speaker = speaker
+        else:
+            listToReturn.append(i["text"].strip())
+
+    result = "\n".join(listToReturn)
+    if language_code == "ru":
+        result = result.replace("SPEAKER_", "Участник_")
+
+    return result
@@ -0,0 +1,100 @@
+import threading
+import logging
+import time
+
+from collections import OrderedDict
+from telebot import types
+from src.limits import get_int_env
+from src.db.db import upsert_users
+
+# Через сколько секунд обновлять в базе пользователя, даже если он не менялся
+USER_CACHE_TTL = get_int_env("USER_CACHE_TTL", 3600)
+# Сколько пользователей помнить, самые давние вытесняются
+USER_CACHE_SIZE = get_int_env("USER_CACHE_SIZE", 100000)
+# Как часто записывать накопившиеся изменения, в секундах
+USER_FLUSH_INTERVAL = get_int_env("USER_FLUSH_INTERVAL", 5)
+
+# id пользователя -> (профиль, когда он был записан в базу)
+saved_users: OrderedDict[int, tuple[tuple, float]] = OrderedDict()
+pending_users: dict[int, dict] = {}
+users_lock = threading.Lock()
+flusher_started = False
+
+
+def get_user_values(user: types.User) -> dict:
+    return dict(
+        id=user.id,
+        user_name=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name,
+    )
+
+
+def remember_user(user_id: int, profile: tuple) -> None:
+    saved_users[user_id] = (profile, time.monotonic())
+    saved_users.move_to_end(user_id)
+    while len(saved_users) > USER_CACHE_SIZE:
+        saved_users.popitem(last=False)
+
+
+def register_user(message: types.Message) -> None:
+    """Сохраняет отправителя сообщения, не обращаясь к базе без необходимости.
+
+    Нового пользователя записываем сразу - на него ссылаются транскрипции.
+    Изменения профиля уже известного и продление по USER_CACHE_TTL
+    записываются в фоне, пачками.
+    """
+    values = get_user_values(message.from_user)
+    profile = (values["user_name"], values["first_name"], values["last_name"])
+
+    with users_lock:
+        saved = saved_users.get(values["id"])
+        if saved is not None:
+            saved_profile, saved_at = saved
+            expired = time.monotonic() - saved_at >= USER_CACHE_TTL
+            if saved_profile == profile and not expired:
+                saved_users.move_to_end(values["id"])
+                return
+
+            pending_users[values["id"]] = values
+            remember_user(values["id"], profile)
+            start_flusher()
+            return
+
+    upsert_users([values])
+    with users_lock:
+        remember_user(values["id"], profile)
+
+
+def flush_users() -> None:
+    global pending_users
+
+    with users_lock:
+        users, pending_users = pending_users, {}
+
+    if not users:
+        return
+
+    try:
+        upsert_users(list(users.values()))
+    except Exception as e:
+        logging.error(f"Unable to save {len(users)} users: {e}")
+        with users_lock:
+            # Более свежие изменения, пришедшие за это время, важнее
+            pending_users = {**users, **pending_users}
+
+
+def flush_users_periodically() -> None:
+    while True:
+        time.sleep(USER_FLUSH_INTERVAL)
+        flush_users()
+
+
+def start_flusher() -> None:
+    global flusher_started
+
+    if not flusher_started:
+        flusher_started = True
+        threading.Thread(
+            target=flush_users_periodically, name="user-flusher", daemon=True
+        ).start()
@@ -1,23 +1,34 @@
 import markdown  # pip install markdown
+import aiohttp
+import hashlib
+import json
 import os
-import requests
 import logging
-import time
+
+from typing import Awaitable, Callable, Optional
 
 from src.localization import get_localized
+from src.limits import get_int_env, llm_limit
+from src import http_client
+from src.http_client import LLM
 from src.db.db import (
     get_user,
     create_user,
     save_transcription,
     save_summary,
     get_transcription,
-    get_prompt_by_name,
 )
+from src.prompt_registry import get_prompt_by_name
 
 from bs4 import BeautifulSoup  # pip install beautifulsoup4
 
 MESSAGE_LIMIT = 4096
 
+LLM_MODEL = os.getenv("LLM_MODEL")
+
+# Получать ответ LLM по частям, чтобы показывать его по мере генерации
+LLM_STREAMING = get_int_env("LLM_STREAMING", 1) == 1
+
 
 def get_dir_name(chat_id: int, msg_id: int):
     return f"files/{str(chat_id)}_{str(msg_id)}"
@@ -27,77 +38,86 @@ def get_file_name(chat_id: int, msg_id: int, text_type: str) -> str:
     return f"files/{str(chat_id)}_{str(msg_id)}_{text_type}.txt"
 
 
+def get_file_hash(file_name: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_name, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
 def md_to_text(md):
     html = markdown.markdown(md)
     soup = BeautifulSoup(html, features="html.parser")
     return soup.get_text()
 
 
-def generate_transcription(audio_file):
-    url = "http://192.168.1.90:8000/api/transcription"
-    files = {"file": open(audio_file, "rb")}
+async def read_stream(
+    response: aiohttp.ClientResponse, on_partial: Callable[[str], Awaitable]
+) -> str:
+    """Собирает ответ из потока server-sent events, сообщая о каждом новом куске.
 
-    response = requests.post(url, files=files)
-    responseData = response.json()
-    id = responseData["id"]
-
-    while True:
-        response = requests.get(
-            "http://192.168.1.90:8000/api/result", params={"id": id})
-        responseData = response.json()
-
-        status = responseData["status"]
-        if status == 'error':
-            raise responseData
+    Оборванный поток, событие с ошибкой и пустой ответ считаются ошибкой,
+    чтобы неполный текст не сохранился как саммари.
+    """
+    content = ""
+    done = False
+    async for line in response.content:
+        line = line.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue
 
-        if status == 'done':
-            responseData = responseData["data"]
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            done = True
             break
 
-        time.sleep(5)
-        
-    language_code = responseData["language"]
-    
-    listToReturn = []
+        event = json.loads(data)
+        if "error" in event:
+            raise ValueError(f"Ошибка LLM: {event['error']}")
 
-    prev_speaker = None
+        choices = event.get("choices")
+        delta = choices[0].get("delta", {}).get("content") if choices else None
+        if delta:
+            content += delta
+            await on_partial(content)
 
-    for i in responseData["segments"]:
-        speaker = None
-        if isinstance(i, dict) and "speaker" in i:
-            speaker = i["speaker"]
-        else:
-            speaker = get_localized("unknown_speaker", language_code)
+    if not done:
+        raise ValueError("Ошибка: поток ответа LLM оборвался до [DONE]")
+    if not content:
+        raise ValueError("Ошибка: LLM вернула пустой ответ")
 
-        if prev_speaker != speaker:
-            listToReturn.append(f'{speaker}: {i["text"].strip()}')
-            prev_speaker = speaker
-        else:
-            listToReturn.append(i["text"].strip())
+    return content
 
-    result = "\n".join(listToReturn)
-    if language_code == "ru":
-        result = result.replace("SPEAKER_", "Участник_")
 
-    return result
-
-
-def generate_summary(text="Привет", system_prompt="Сделай саммаризацию"):
+async def generate_summary(
+    text="Привет",
+    system_prompt="Сделай саммаризацию",
+    on_partial: Optional[Callable[[str], Awaitable]] = None,
+):
     llm_host = os.getenv("LLM_URL")
     url = f"{llm_host}/v1/chat/completions"
+    stream = LLM_STREAMING and on_partial is not None
 
     data = {
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": f"""{text}"""},
         ],
-        "stream": False,
+        "stream": stream,
     }
+    if LLM_MODEL:
+        data["model"] = LLM_MODEL
+
+    async with llm_limit:
+        async with http_client.request(LLM, "POST", url, json=data) as response:
+            response.raise_for_status()
+            if stream:
+                return await read_stream(response, on_partial)
 
-    response = requests.post(url, json=data)
-    response.raise_for_status()
+            json_response = await response.json(content_type=None)
 
-    json_response = response.json()
     if (
         "choices" in json_response
         and len(json_response["choices"])